@@ -0,0 +1,49 @@
+""" Depth balanced (AVL) join shared by Rope and PVec.
+
+Both are binary trees with chunks at the leaves and left, right, chunk,
+length and depth fields. Nodes are built by the class of their children,
+whose CHUNK is the longest leaf that adjacent leaves are merged into.
+"""
+
+
+def node(left, right):
+    cls = type(left)
+    if left.is_leaf() and right.is_leaf() \
+            and left.length + right.length <= cls.CHUNK:
+        return cls(chunk=left.chunk + right.chunk)
+    return cls(left, right)
+
+
+def rotate_left(v):
+    return node(node(v.left, v.right.left), v.right.right)
+
+
+def rotate_right(v):
+    return node(v.left.left, node(v.left.right, v.right))
+
+
+def rebalance(v):
+    if v.is_leaf():
+        return v
+    if v.right.depth > v.left.depth + 1:
+        if v.right.left.depth > v.right.right.depth:
+            v = node(v.left, rotate_right(v.right))
+        return rotate_left(v)
+    if v.left.depth > v.right.depth + 1:
+        if v.left.right.depth > v.left.left.depth:
+            v = node(rotate_left(v.left), v.right)
+        return rotate_right(v)
+    return v
+
+
+def concat(a, b):
+    """ AVL join, O(|depth(a) - depth(b)|) """
+    if a.length == 0:
+        return b
+    if b.length == 0:
+        return a
+    if a.depth > b.depth + 1:
+        return rebalance(node(a.left, concat(a.right, b)))
+    if b.depth > a.depth + 1:
+        return rebalance(node(concat(a, b.left), b.right))
+    return node(a, b)
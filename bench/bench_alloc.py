@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+""" Allocations of inline lambdas: `xs each {x * 2}` run N times.
+
+Counts Tree nodes built while running and reports the tracemalloc peak.
+A lambda's baked body is built once, so the count shouldn't grow with the
+size of its body.
+
+    bench_alloc.py [N] [LEN]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+import c
+from hb import Execute, Cactus, ROOT_TAG, prepare_env
+
+
+PROGRAM = """
+xs is ((0 til %(len)d) toseq () tovec ())
+| %(n)d for {i | .$xs each {x * 2 + (x * 3) + (x * 4) + (x * 5)}}
+"""
+
+
+def count_trees():
+    counter = [0]
+    init = c.Tree.__init__
+
+    def counting_init(self, *args, **kwargs):
+        counter[0] += 1
+        init(self, *args, **kwargs)
+
+    c.Tree.__init__ = counting_init
+    return counter
+
+
+def run(n, length):
+    env = prepare_env()
+    cstack = Cactus(ROOT_TAG)
+    t = time.perf_counter()
+    Execute(PROGRAM % {"n": n, "len": length}, env, cstack)
+    return time.perf_counter() - t
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    os.chdir(ROOT)
+
+    dt = run(n, length)
+
+    # Count again without timing, tracing slows everything down
+    counter = count_trees()
+    tracemalloc.start()
+    run(n, length)
+    _, peak = tracemalloc.get_traced_memory()
+
+    calls = n * length
+    print(f"calls={calls} {dt:.2f}s {dt / calls * 1e6:.2f}us/call"
+          f" trees/call={counter[0] / calls:.1f} peak={peak / 1e6:.2f}MB")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+""" Budgets: cost of the checks, how soon a runaway program is stopped,
+and time slicing. Under one asyncio loop a long program runs next to
+short ones, with slices the short ones don't wait for it to finish.
+
+    bench_budget.py [N] [overhead|stop|slice ...]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+import hb
+from hb import Budget, Execute, ExecuteAsync, Cactus, ROOT_TAG, prepare_env
+
+
+GCD = """
+{a:b | b = 0 then [a] : [b F (a mod b)]} as gcd
+| %(n)d for {i | 832040 gcd 514229}
+"""
+# A native op is charged before it runs, only fuel can refuse it
+RUNAWAY = {
+    "recursion": ("{a:b | a F b} as loop | 1 loop 2", {"seconds": 0.05}),
+    "while": ("0 as i | [1] while [(.$i + 1) assign i]", {"seconds": 0.05}),
+    "til": ("(0 til 1000000000) tovec ()", {"fuel": 10 ** 6}),
+}
+SUM = "0 as s | %(n)d for {i | (.$s + i) assign s} | .$s"
+
+
+def run(code, budget=None):
+    t = time.perf_counter()
+    x, _, _, _ = Execute(code, prepare_env(), Cactus(ROOT_TAG), budget=budget)
+    return x, time.perf_counter() - t
+
+
+def overhead(n):
+    # Budgeted code is interpreted, compare with interpreter only
+    hb.HOT_CALLS = 0
+    _, free = run(GCD % {"n": n})
+    _, budgeted = run(GCD % {"n": n}, Budget(fuel=10 ** 12, seconds=3600))
+    hb.HOT_CALLS = 20
+    print(f"overhead   free={free:.2f}s budgeted={budgeted:.2f}s")
+
+
+def stop(n):
+    for name, (code, limits) in RUNAWAY.items():
+        x, dt = run(code, Budget(**limits))
+        print(f"stop {name:<10} {x} after {dt * 1e3:.1f}ms {limits}")
+
+
+async def timed(code, budget, start):
+    x, _, _, _ = await ExecuteAsync(code, prepare_env(), Cactus(ROOT_TAG), budget)
+    return x, time.perf_counter() - start
+
+
+async def sliced(n, slice):
+    start = time.perf_counter()
+    budget = lambda: None if slice is None else Budget(slice=slice)
+    programs = [SUM % {"n": n * 100}] + [SUM % {"n": n}] * 10
+    return await asyncio.gather(*(timed(code, budget(), start) for code in programs))
+
+
+def slices(n):
+    for slice in (None, 10_000):
+        results = asyncio.run(sliced(n, slice))
+        (_, long), short = results[0], [dt for _, dt in results[1:]]
+        print(f"slice={slice} long={long:.2f}s"
+              f" short done by {max(short) * 1e3:.0f}ms")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    modes = sys.argv[2:] or ["overhead", "stop", "slice"]
+    os.chdir(ROOT)
+
+    for mode in modes:
+        {"overhead": overhead, "stop": stop, "slice": slices}[mode](n)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+""" Resume cost of a generator whose continuation sits deep in the stack.
+
+Generator recurses DEPTH levels (non tail) before it starts yielding, so
+every captured continuation holds at least DEPTH frames. Mode "lib" uses
+lib/coroutine.hb (reset/shift), "native" the gen/yield/next builtins.
+
+    bench_generator.py [N] [DEPTH] [lib|native]
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+from hb import Execute, Cactus, ROOT_TAG, prepare_env
+
+
+PROGRAMS = {}
+
+PROGRAMS["lib"] = """
+() import "lib/coroutine.hb"
+| ylp is {i | i yield () | (i + 1) F ()}
+| deep is {d | d = 0 then [0 ylp ()] : [((d - 1) F ()) + 0]}
+| g is ([.$x deep ()] gen ())
+| drive is {p.n | n <= 1 then [p L ()] : [(() (p R ()) ()) F (n - 1)]}
+| (%(depth)d g ()) drive %(n)d
+"""
+
+PROGRAMS["native"] = """
+ylp is {i | i yield () | (i + 1) F ()}
+| deep is {d | d = 0 then [0 ylp ()] : [((d - 1) F ()) + 0]}
+| g is ({d | d deep ()} gen %(depth)d)
+| drive is {g.n | n <= 1 then [g next ()] : [g next () | g F (n - 1)]}
+| (.$g) drive %(n)d
+"""
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    mode = sys.argv[3] if len(sys.argv) > 3 else "native"
+    sys.setrecursionlimit(10000)
+    os.chdir(ROOT)
+
+    env = prepare_env()
+    cstack = Cactus(ROOT_TAG)
+    t = time.perf_counter()
+    x, _, _, _ = Execute(PROGRAMS[mode] % {"n": n, "depth": depth}, env, cstack)
+    dt = time.perf_counter() - t
+    print(f"{mode} last={x} n={n} depth={depth} {dt:.2f}s {dt / n * 1e6:.1f}us/resume")
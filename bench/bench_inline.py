@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+""" Calls of small prelude helpers and lambdas, with and without inlining.
+
+    bench_inline.py [N] [bang|rep|lambda ...]
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+import hb
+from hb import Execute, Cactus, ROOT_TAG, prepare_env
+
+
+PROGRAMS = {
+    "bang": """
+() import "lib/prelude.hb"
+| 0 as s
+| %(n)d for {i | (i ! {x + (.$s)}) assign s}
+| .$s
+""",
+    "rep": """
+() import "lib/prelude.hb"
+| %(n)d for {i | i rep 3}
+""",
+    "lambda": """
+(0 til %(n)d) toseq () tovec () each {x * 2} fold {x + y}
+""",
+}
+
+
+def run(program, n):
+    env = prepare_env()
+    cstack = Cactus(ROOT_TAG)
+    calls = hb.inlined_calls
+    t = time.perf_counter()
+    x, _, _, _ = Execute(program % {"n": n}, env, cstack)
+    return x, time.perf_counter() - t, hb.inlined_calls - calls
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    modes = sys.argv[2:] or list(PROGRAMS)
+    os.chdir(ROOT)
+
+    inline_max = hb.INLINE_MAX
+    for mode in modes:
+        hb.INLINE_MAX = 0
+        x, dt_call, _ = run(PROGRAMS[mode], n)
+        hb.INLINE_MAX = inline_max
+        hb.inline_templates.clear()
+        x, dt, inlined = run(PROGRAMS[mode], n)
+        print(f"{mode:<7} result={x} n={n} call {dt_call:.2f}s"
+              f" inline {dt:.2f}s calls avoided={inlined}")
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+""" Counting loop: lib/loop.hb (reset + recursive F) vs native for/while.
+
+    bench_loop.py [N] [lib|for|while ...]
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+from hb import Execute, Cactus, ROOT_TAG, prepare_env
+
+
+PROGRAMS = {
+    "lib": """
+() import "lib/loop.hb"
+| 0 as s
+| lp loop [(.$i >= %(n)d) then [lp break (.$s)] : [(.$s + (.$i)) assign s]]
+""",
+    "for": """
+0 as s
+| %(n)d for {i | (.$s + i) assign s}
+| .$s
+""",
+    "while": """
+0 as s
+| 0 as i
+| [.$i < %(n)d] while [(.$s + (.$i)) assign s | (.$i + 1) assign i]
+| .$s
+""",
+}
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    modes = sys.argv[2:] or list(PROGRAMS)
+    os.chdir(ROOT)
+
+    for mode in modes:
+        env = prepare_env()
+        cstack = Cactus(ROOT_TAG)
+        t = time.perf_counter()
+        x, _, _, _ = Execute(PROGRAMS[mode] % {"n": n}, env, cstack)
+        dt = time.perf_counter() - t
+        print(f"{mode:<6} result={x} n={n} {dt:.2f}s {dt / n * 1e6:.2f}us/iter")
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+""" Numeric inner loops: gcd of consecutive Fibonacci numbers, prelude pow
+and factorial, and a counting while loop. With --interp hot functions
+aren't compiled.
+
+    bench_num.py [--interp] [N] [gcd|pow|fac|count ...]
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+import hb
+from hb import Execute, Cactus, ROOT_TAG, prepare_env
+
+
+PROGRAMS = {
+    # 832040 and 514229 are F(30) and F(29), gcd takes 28 steps
+    "gcd": """
+{a:b | b = 0 then [a] : [b F (a mod b)]} as gcd
+| %(n)d for {i | 832040 gcd 514229}
+""",
+    "pow": """
+() import "lib/prelude.hb"
+| %(n)d for {i | 3 pow 40}
+""",
+    "fac": """
+() import "lib/prelude.hb"
+| %(n)d for {i | 30 factorial ()}
+""",
+    "count": """
+0 as i
+| [.$i < %(m)d] while [(.$i + 1) assign i]
+| .$i
+""",
+}
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if "--interp" in args:
+        args.remove("--interp")
+        hb.HOT_CALLS = 0
+    n = int(args[0]) if args else 1000
+    modes = args[1:] or list(PROGRAMS)
+    os.chdir(ROOT)
+
+    for mode in modes:
+        env = prepare_env()
+        cstack = Cactus(ROOT_TAG)
+        t = time.perf_counter()
+        x, _, _, _ = Execute(PROGRAMS[mode] % {"n": n, "m": n * 20}, env, cstack)
+        dt = time.perf_counter() - t
+        print(f"{mode:<6} result={x} n={n} {dt:.2f}s {dt / n * 1e6:.2f}us/iter")
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+""" peach against each on a CPU-heavy function: every item runs a 100 step
+loop that reads a free variable, so it stays in the interpreter.
+Speedup is relative to serial each, so it needs as many cores as jobs.
+Workers are started by the first peach and reused by the next ones.
+
+    bench_peach.py [LEN] [JOBS ...]
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+import hb
+from hb import Execute, Cactus, ROOT_TAG, prepare_env
+
+
+PROGRAM = """
+xs is ((0 til %(len)d) toseq () tovec ())
+| (.$xs %(each)s {n | 100 {i.acc | i = 0 then [acc] : [i - 1 F (acc + (i mod (n + 1)))]} 0}) len ()
+"""
+
+
+def run(length, each):
+    env = prepare_env()
+    cstack = Cactus(ROOT_TAG)
+    t = time.perf_counter()
+    x, _, _, _ = Execute(PROGRAM % {"len": length, "each": each}, env, cstack)
+    return x, time.perf_counter() - t
+
+
+if __name__ == "__main__":
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    jobs = [int(j) for j in sys.argv[2:]] or [1, 2, 4, 8]
+    os.chdir(ROOT)
+
+    print(f"cores={os.cpu_count()} len={length}")
+    _, serial = run(length, "each")
+    print(f"each     {serial:.2f}s")
+    for j in jobs:
+        hb.JOBS = j
+        # First call starts the worker pool, later ones reuse it
+        _, first = run(length, "peach")
+        x, dt = run(length, "peach")
+        print(f"peach -j {j} {dt:.2f}s (first {first:.2f}s)"
+              f" speedup={serial / dt:.2f}x result={x}")
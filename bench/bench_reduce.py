@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+""" Reductions of a big num_vec: sum, max, fold + and foldby + over N
+numbers, serially and by 1/2/4/8 workers on shared memory, as with hb.py -j.
+Speedup needs as many cores as workers.
+
+    bench_reduce.py [N] [JOBS ...]
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+from c import Leaf, Tree, TT
+import hb
+import parallel
+
+
+def timed(fn):
+    t = time.perf_counter()
+    x = fn()
+    return x, time.perf_counter() - t
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    jobs = [int(j) for j in sys.argv[2:]] or [1, 2, 4, 8]
+
+    xs = list(range(n))
+    keys = [x % 16 for x in xs]
+    modules = hb.all_modules()["num_vec"]
+    num_vec = Leaf("num_vec", xs)
+    cases = {
+        "sum": lambda: modules["sum"](num_vec, None),
+        "max": lambda: modules["max"](num_vec, None),
+        "fold +": lambda: hb.num_fold(num_vec, Leaf(TT.SYMBOL, "+")),
+        "foldby +": lambda: hb.num_fold_by(
+            num_vec, Tree(Leaf("num_vec", keys), Leaf(TT.PUNCTUATION, ":"),
+                          Leaf(TT.SYMBOL, "+"))),
+    }
+
+    print(f"cores={os.cpu_count()} n={n}")
+    for name, fn in cases.items():
+        # Serial run is the reference
+        parallel.JOBS = 1
+        expected, serial = timed(fn)
+        line = f"{name:<9} serial {serial:.2f}s"
+        for j in jobs:
+            parallel.JOBS = j
+            x, dt = timed(fn)
+            assert x.w == expected.w
+            line += f" | -j {j} {dt:.2f}s {serial / dt:.2f}x"
+        print(line)
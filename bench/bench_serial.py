@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+""" Encode/decode throughput of the binary codec vs. pickle. """
+
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from c import Leaf, TT
+from hb import Execute, Env, Cactus, ROOT_TAG, prepare_env, get_codec
+
+
+def bench(name, fn, n):
+    t = time.perf_counter()
+    for _ in range(n):
+        fn()
+    dt = (time.perf_counter() - t) / n
+    return dt
+
+
+def run(name, x, root, n=20):
+    codec = get_codec()
+    data = codec.dumps(x, root=root)
+    enc = bench("encode", lambda: codec.dumps(x, root=root), n)
+    dec = bench("decode", lambda: codec.loads(data, root=root), n)
+    mb = len(data) / 1e6
+    print(f"{name:<24} {len(data):>10} B"
+          f"  enc {mb / enc:7.1f} MB/s  dec {mb / dec:7.1f} MB/s")
+
+    try:
+        pdata = pickle.dumps(x)
+        print(f"{'  (pickle)':<24} {len(pdata):>10} B")
+    except Exception as exc:
+        print(f"{'  (pickle)':<24} failed: {type(exc).__name__}")
+
+
+if __name__ == "__main__":
+    env = prepare_env()
+    cstack = Cactus(ROOT_TAG)
+    Execute('() IP ()', env, cstack)
+
+    run("num_vec 100k", Leaf("num_vec", list(range(100_000))), env)
+    run("vec of NUM 100k",
+        Leaf("vec", [Leaf(TT.NUM, i) for i in range(100_000)]), env)
+    run("vec of STRING 100k",
+        Leaf("vec", [Leaf(TT.STRING, f"s{i}") for i in range(100_000)]), env)
+    run("prelude env", Leaf(TT.OBJECT, Env(env, from_dict=env.e)), None, n=5)
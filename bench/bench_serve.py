@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+""" Latency of a trivial script sent to a warm `hb.py serve` against a cold
+`hb.py run` of it, both with the prelude imported.
+
+    bench_serve.py [N] [WORKERS]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+import server
+
+
+SCRIPT = '"hi" print () | 3 pow 4'
+COLD_RUNS = 5
+
+
+def wait_for(path, proc):
+    while not os.path.exists(path):
+        if proc.poll() is not None:
+            raise SystemExit("server didn't start")
+        time.sleep(0.05)
+
+
+def cold():
+    src = '() import "lib/prelude.hb" | ' + SCRIPT
+    times = []
+    for _ in range(COLD_RUNS):
+        t = time.perf_counter()
+        subprocess.run([sys.executable, "hb.py", "run"], input=src.encode(),
+                       check=True, capture_output=True)
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def warm(n, workers):
+    path = os.path.join(tempfile.mkdtemp(), "hb.sock")
+    proc = subprocess.Popen([sys.executable, "hb.py", "-j", str(workers), "serve", path],
+                            stderr=subprocess.DEVNULL)
+    try:
+        wait_for(path, proc)
+        times = []
+        for _ in range(n):
+            t = time.perf_counter()
+            reply = server.send(SCRIPT, path)
+            times.append(time.perf_counter() - t)
+        assert reply == {"result": "81", "stdout": "hi\n", "stderr": ""}, reply
+        return times
+    finally:
+        proc.terminate()
+        proc.wait()
+        os.rmdir(os.path.dirname(path))
+
+
+def report(name, times):
+    times = sorted(times)
+    p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+    print(f"{name:<5} n={len(times)} p50={statistics.median(times) * 1e3:.2f}ms"
+          f" p99={p99 * 1e3:.2f}ms")
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    os.chdir(ROOT)
+
+    report("cold", cold())
+    report("warm", warm(n, workers))
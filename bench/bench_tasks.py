@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+""" Green threads: a pipeline of TASKS stages joined by channels, each
+adding 1 to every item that passes. Main feeds ITEMS numbers in and sums
+what comes out.
+
+    bench_tasks.py [TASKS] [ITEMS]
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+from hb import Execute, Cactus, ROOT_TAG, prepare_env
+
+
+PROGRAM = """
+stage is {inp.out | (inp recv ()) + 1 as x | out send (.$x) | inp F out}
+| first is (1 chan ())
+| last is ((0 til %(tasks)d) toseq () tovec () fold ({c.i |
+    out is (1 chan ()) | (.$stage) spawn (c : (.$out)) | .$out} : (.$first)))
+| feeder is ({n | (0 til n) toseq () tovec () each {i | (.$first) send i}} spawn %(items)d)
+| (0 til %(items)d) toseq () tovec () fold ({acc.i | acc + ((.$last) recv ())} : 0)
+"""
+
+
+if __name__ == "__main__":
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    items = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    os.chdir(ROOT)
+
+    env = prepare_env()
+    cstack = Cactus(ROOT_TAG)
+    t = time.perf_counter()
+    x, _, _, _ = Execute(PROGRAM % {"tasks": tasks, "items": items}, env, cstack)
+    dt = time.perf_counter() - t
+    hops = tasks * items
+    print(f"tasks={tasks} items={items} result={x} {dt:.2f}s"
+          f" {dt / hops * 1e6:.1f}us/hop")
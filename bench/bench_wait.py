@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+""" Concurrent sleeps: N green threads of one program each `wait 1`, then
+N separate programs each `wait 1` under one asyncio loop. Both should take
+about as long as a single wait.
+
+    bench_wait.py [N] [PROGRAMS]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+
+from hb import Execute, ExecuteAsync, Cactus, ROOT_TAG, prepare_env
+
+
+TASKS = """
+ts is ((0 til %(n)d) toseq () tovec () each {i | {x | x wait 1} spawn i})
+| .$ts fold ({acc.t | acc + (t join ())} : 0)
+"""
+
+PROGRAM = """
+%(i)d wait 1
+"""
+
+
+async def programs(n):
+    return await asyncio.gather(*(
+        ExecuteAsync(PROGRAM % {"i": i}, prepare_env(), Cactus(ROOT_TAG))
+        for i in range(n)))
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    m = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    t = time.perf_counter()
+    x, _, _, _ = Execute(TASKS % {"n": n}, prepare_env(), Cactus(ROOT_TAG))
+    print(f"tasks={n} result={x} {time.perf_counter() - t:.2f}s")
+
+    t = time.perf_counter()
+    results = asyncio.run(programs(m))
+    total = sum(x.w for x, _, _, _ in results)
+    print(f"programs={m} result={total} {time.perf_counter() - t:.2f}s")
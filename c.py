@@ -16,6 +16,10 @@ class ParseError(WitnessedError):
     pass
 
 
+class TypecheckError(Exception):
+    pass
+
+
 class DebugInfo:
 
     def __init__(self, start, end, lineno):
@@ -28,7 +32,7 @@ class DebugInfo:
         # Inherit line from start # NOTE merge start to end lines in error report
         start = L.debug.start if L.debug is not None else None
         end = R.debug.end if R.debug is not None else None
-        lineno = L.debug.start if L.debug is not None else None
+        lineno = L.debug.lineno if L.debug is not None else None
         return DebugInfo(start, end, lineno)
 
     def __str__(self):
@@ -88,15 +92,17 @@ class Tree:
         # lparen = '{' if function else '['
         # rparen = '}' if function else ']'
         # return f"{lparen}{n.L} {n.H} {n.R}{rparen}"
-        if n.H.tt == TT.SEPARATOR:
+        # Head resolved ahead of time shows as written
+        H = getattr(n.H, "source", n.H)
+        if H.tt == TT.SEPARATOR:
             return f"{n.L} | ({n.R})"
-        if n.H.tt == TT.SYMBOL:
-            return f"({n.L} {n.H} {n.R})"
-        if n.H.tt == TT.PUNCTUATION:
-            if isinstance(n.H, Leaf) and right_associative(n.H):
-                return f" ({n.L}{n.H}{n.R})"
-            return f"({n.L} {n.H}{n.R})"
-        return f"{n.L} {n.H}{n.R}"
+        if H.tt == TT.SYMBOL:
+            return f"({n.L} {H} {n.R})"
+        if H.tt == TT.PUNCTUATION:
+            if isinstance(H, Leaf) and right_associative(H):
+                return f" ({n.L}{H}{n.R})"
+            return f"({n.L} {H}{n.R})"
+        return f"{n.L} {H}{n.R}"
 
     def __repr__(self):
         return self.show()
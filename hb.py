@@ -1,25 +1,94 @@
 #!/usr/bin/env python3
 
+from collections import deque
+import heapq
+import itertools
+import operator
+import os
 import sys
 import time
+import weakref
 
 from c import Lex, Parse, TT, Tree, Leaf, Unit, \
-    WitnessedError, ParseError, DebugInfo
+    WitnessedError, ParseError, TypecheckError, DebugInfo
 
-from stack import Cactus, CT, Frame
+from stack import Cactus, CT, Frame, Stack
+import hmap
 import matrix
+import parallel
+import pvec
+import record
+from record import Record
+import rope
+from seq import Seq
+import serial
+import strvec
 
 
 ROOT_TAG = "__root__"
+GEN_TAG = "__gen__"
+TASK_TAG = "__task__"
 SELF_F = "F"
 DISPATCH_SEP = ":"
 
+# NUM op NUM builtins that Eval computes directly instead of dispatching.
+# Must agree with their entries in the NUM module and BUILTINS
+NUM_OPS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.floordiv,
+    "mod": operator.mod,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "=": operator.eq,
+    "and": lambda a, b: a != 0 and b != 0,
+    "or": lambda a, b: a == 1 or b == 1,
+}
+# Binding any of these names may change what NUM op NUM dispatches to, or
+# `then` that compiled function bodies branch with
+NUM_OP_NAMES = frozenset([*NUM_OPS, "NUM", "then",
+                          *(f"{op}{DISPATCH_SEP}NUM" for op in NUM_OPS),
+                          f"then{DISPATCH_SEP}{TT.TREE}"])
+# Version guard of the fast path and compiled bodies, bumped by overriding
+# bindings. Only goes back for a program given a fresh env, see
+# recheck_overrides
+num_ops_overrides = 0
+# Guarded names bound to something else than their builtin: NUM_OP_NAMES
+# and builtins the optimizer resolves heads to
+overridden = set()
+# NUM_OP_NAMES and STATIC_NAMES, set once BUILTINS are defined
+GUARDED_NAMES = NUM_OP_NAMES
+
+
+def override(name):
+    global num_ops_overrides
+    overridden.add(name)
+    if name in NUM_OP_NAMES:
+        num_ops_overrides += 1
+
+
+def override_all():
+    """ Bindings were made without Env.bind, eg. by decoding an env """
+    for name in GUARDED_NAMES:
+        override(name)
+
 
 class UnexpectedType(Exception): pass
 class CantReduce(WitnessedError): pass
 class NoDispatch(WitnessedError): pass
 
 
+class Raised(Exception):
+    """ Raised hb value leaving a nested Eval without a handler in it """
+
+    def __init__(self, value):
+        super().__init__(str(value))
+        self.value = value
+
+
 class Shift:
     """ Instance of some continuation travelling the stack.  Eg. raised error.
     Used when a native function wants to throw an error or raise some other
@@ -32,6 +101,12 @@ class Shift:
 
 
 class Env:
+    # Warm root of a server and its modules, every request runs in a child
+    shared = False
+    # Some closure or continuation holds on to it, see Eval tail calls
+    captured = False
+    # Guarded names a shared env overrides, see recheck_overrides
+    overrides = None
 
     def __init__(self, parent, from_dict=None):
         # self.parent = parent
@@ -40,28 +115,48 @@ class Env:
         # self.e[":"] = parent
 
     def lookup(self, name, or_else):
-        env = self.find_env(name)
-        if not env:
-            return or_else
-        return env.e[name]
+        # Walk Env chain in a loop, it's as deep as the recursion.
+        # Delegate to parent's lookup if parent is a Record
+        env = self
+        while type(env) is Env:
+            if name in env.e:
+                return env.e[name]
+            env = env.parent
+        if env:
+            return env.lookup(name, or_else)
+        return or_else
 
     def find_env(self, name):
-        # TODO optimize self-recursion in tail calls by reusing env
-        if name in self.e:
-            return self
-        else:
+        env = self
+        while type(env) is Env:
+            if name in env.e:
+                return env
             # parent = self.e.get(":")
-            parent = self.parent
-            if parent:
-                return parent.find_env(name)
+            env = env.parent
+        if env:
+            return env.find_env(name)
         return None
 
     def bind(self, name, value):
+        if name in GUARDED_NAMES:
+            override(name)
         self.e[name] = value
         return value
 
+    def capture(self):
+        """ Mark env and its parents as held on to by a closure """
+        env = self
+        while type(env) is Env and not env.captured:
+            env.captured = True
+            env = env.parent
+
     def assign(self, name, value):
         env = self.find_env(name) or self
+        if env.shared:
+            # Copy on write, bind it in the outermost env that isn't shared
+            env = self
+            while type(env.parent) is Env and not env.parent.shared:
+                env = env.parent
         env.bind(name, value)
         return value
 
@@ -114,13 +209,32 @@ def makefunc(a, b, env, cstack):
 
 
 def iscons(x):
-    return x.tt == TT.PUNCTUATION and x.w in (".", ":")
+    return x.tt is TT.PUNCTUATION and x.w in (".", ":")
+
 
+# Source thunk -> (left_name, right_name, baked body). Baking copies the
+# whole body, do it once per thunk, not on every call of an inline lambda
+baked_bodies = weakref.WeakKeyDictionary()
 
-def makefunc_(a, env):
+
+def makefunc_(a, env, capture=True):
     if a.tt not in (TT.THUNK, TT.FUNTHUNK):
         raise Exception(f"Can't create function out of '{a.tt}'")
 
+    left_name, right_name, body = baked_of(a)
+    if capture:
+        env.capture()
+    return Leaf(TT.FUNCTION, Function(left_name, right_name, body, env), debug=body.debug)
+
+
+def baked_of(a):
+    baked = baked_bodies.get(a)
+    if baked is None:
+        baked = baked_bodies[a] = bake(a)
+    return baked
+
+
+def bake(a):
     body = a.w
 
     left_name, right_name = "x", "y"
@@ -139,7 +253,281 @@ def makefunc_(a, env):
             #raise TypecheckError(f"Fn header expected cons TREE | SYMBOL. Got {header.tt}")
 
     body = bakevars(body, [left_name, right_name])
-    return Leaf(TT.FUNCTION, Function(left_name, right_name, body, env), debug=body.debug)
+    return left_name, right_name, body
+
+
+# Inline FUNTHUNK bodies up to this many nodes
+INLINE_MAX = 16
+# Heads whose effect depends on the env they run in. Inlined body runs in
+# caller's env instead of its own
+ENV_HEADS = frozenset(["is", "as", "assign", "bakevar", "func", "asmod",
+                       "load", "import", "IP", "?", "showenv"])
+# The env and its parent as values, eg. `. @ (k : x)`, same reason. Reads
+# `. $ name` are fine
+ENV_VALUES = frozenset([".", ":"])
+# FUNTHUNK -> inline template or None if it can't be inlined
+inline_templates = weakref.WeakKeyDictionary()
+inlined_calls = 0
+
+
+def param_ref(x, params):
+    """ Param name if x is a param lookup made by bakevars """
+    if isinstance(x, Tree) and x.H.tt is TT.PUNCTUATION and x.H.w == "$" \
+            and x.L.tt is TT.SYMBOL and x.L.w == "." \
+            and x.R.tt is TT.SYMBOL and x.R.w in params:
+        return x.R.w
+    return None
+
+
+def is_env_read(x):
+    """ x is `. $ name` """
+    if not isinstance(x, Tree):
+        return False
+    H = getattr(x.H, "source", x.H)
+    return H.tt is TT.PUNCTUATION and H.w == "$" \
+        and not isinstance(x.L, Tree) and x.L.w == "." \
+        and not isinstance(x.R, Tree) and x.R.tt in (TT.SYMBOL, TT.STRING)
+
+
+def inline_template(a):
+    """ (left_name, right_name, body, head_params) of a FUNTHUNK whose
+    body can run in caller's env with params substituted, or None.
+    Recursive and nested functions are left alone.
+    """
+    left_name, right_name, body = baked_of(a)
+    params = (left_name, right_name)
+    head_params = set()
+    size = 0
+    stack = [(body, False)]
+    while stack:
+        x, head = stack.pop()
+        size += 1
+        if size > INLINE_MAX:
+            return None
+        # Head resolved by optimizer is checked by its name
+        x = getattr(x, "source", x)
+        name = param_ref(x, params)
+        if name is not None:
+            if head:
+                head_params.add(name)
+        elif is_env_read(x):
+            # Same lookup from caller's env as from the callee's fresh one
+            stack.append((x.R, False))
+        elif isinstance(x, Tree):
+            stack += [(x.L, False), (x.H, True), (x.R, False)]
+        elif x.tt is TT.THUNK:
+            stack.append((x.w, False))
+        elif x.tt in (TT.FUNTHUNK, TT.FUNCTION):
+            return None
+        elif x.tt in (TT.SYMBOL, TT.STRING, TT.PUNCTUATION):
+            if x.w == SELF_F or x.w in params or (head and x.w in ENV_HEADS) \
+                    or x.w in ENV_VALUES:
+                return None
+    return left_name, right_name, body, head_params
+
+
+def substitute(x, params, values):
+    name = param_ref(x, params)
+    if name is not None:
+        return values[params.index(name)]
+    if isinstance(x, Tree):
+        return Tree(substitute(x.L, params, values),
+                    substitute(x.H, params, values),
+                    substitute(x.R, params, values))
+    if x.tt is TT.THUNK:
+        return Leaf(TT.THUNK, substitute(x.w, params, values), debug=x.debug)
+    return x
+
+
+def inline(H, L, R):
+    """ Body of FUNTHUNK H applied to L and R, or None to call it """
+    global inlined_calls
+    if H in inline_templates:
+        template = inline_templates[H]
+    else:
+        template = inline_templates[H] = inline_template(H)
+    if template is None or isinstance(L, Tree) or isinstance(R, Tree):
+        # Tree values would be evaluated again once substituted
+        return None
+    left_name, right_name, body, head_params = template
+    for name in head_params:
+        v = L if name == left_name else R
+        if v.tt is TT.SPECIAL or (
+                v.tt in (TT.SYMBOL, TT.STRING, TT.PUNCTUATION) and v.w in ENV_HEADS):
+            return None
+    inlined_calls += 1
+    return substitute(body, (left_name, right_name), (L, R))
+
+
+# Calls with the same operand kinds before a body is compiled
+HOT_CALLS = 20
+# NUM ops with Python operator of the same meaning on ints. Comparisons
+# give bool, converted back to hb 1 and 0
+PY_OPS = {"+": "+", "-": "-", "*": "*", "/": "//", "mod": "%"}
+PY_COMPARISONS = {"<": "<", "<=": "<=", ">": ">", ">=": ">=", "=": "=="}
+# Baked body -> {(left kind, right kind): call count | compiled | False}
+hot_bodies = weakref.WeakKeyDictionary()
+compiled_calls = 0
+
+
+class Uncompilable(Exception): pass
+
+
+def kind_of(x):
+    """ Operand kind a compiled body can be specialized to, or None """
+    if x.tt is TT.NUM and type(x.w) is int:
+        return TT.NUM
+    if x.tt is TT.UNIT:
+        return TT.UNIT
+    return None
+
+
+class Specializer:
+    """ Python source of a function body for int (or unit) params. Covers
+    NUM ops, `then` choosing between branches, param lookups, int literals
+    and calls to F. Tail calls to F loop in place, other calls recurse.
+    """
+
+    def __init__(self, func, kinds):
+        self.kinds = kinds
+        # Right param shadows left one of the same name, like env.bind
+        self.params = {func.left_name: ("a", kinds[0]),
+                       func.right_name: ("b", kinds[1])}
+
+    def source(self, body):
+        lines = ["def compiled(a, b):", "    while True:"]
+        lines += ["        " + line for line in self.tail(body)]
+        return "\n".join(lines)
+
+    def tail(self, x):
+        branches = self.branches(x)
+        if branches is not None:
+            cond, yes, no = branches
+            return [f"if {cond}:", *("    " + y for y in self.tail(yes)),
+                    "else:", *("    " + y for y in self.tail(no))]
+        if self.is_self_call(x):
+            return [f"a, b = {self.args(x)}", "continue"]
+        return [f"return {self.expr(x)}"]
+
+    def expr(self, x):
+        if isinstance(x, Leaf):
+            if x.tt is TT.NUM and type(x.w) is int:
+                return repr(x.w)
+            raise Uncompilable(x)
+
+        name = param_ref(x, self.params)
+        if name is not None:
+            local, kind = self.params[name]
+            if kind is not TT.NUM:
+                raise Uncompilable(x)
+            return local
+
+        branches = self.branches(x)
+        if branches is not None:
+            cond, yes, no = branches
+            return f"({self.expr(yes)} if {cond} else {self.expr(no)})"
+        if self.is_self_call(x):
+            return f"compiled({self.args(x)})"
+
+        fn = head_name(x)
+        if fn in PY_OPS:
+            return f"({self.expr(x.L)} {PY_OPS[fn]} {self.expr(x.R)})"
+        if fn in PY_COMPARISONS:
+            return f"(1 if {self.expr(x.L)} {PY_COMPARISONS[fn]} {self.expr(x.R)} else 0)"
+        # Both sides evaluated, like the builtins
+        if fn == "and":
+            return f"(1 if ({self.expr(x.L)} != 0) & ({self.expr(x.R)} != 0) else 0)"
+        if fn == "or":
+            return f"(1 if ({self.expr(x.L)} == 1) | ({self.expr(x.R)} == 1) else 0)"
+        raise Uncompilable(x)
+
+    def branches(self, x):
+        """ (cond, yes, no) of `cond then [yes] : [no]` """
+        if head_name(x) != "then" or not isinstance(x.R, Tree) \
+                or not iscons(x.R.H):
+            return None
+        yes, no = (unwrap(y) if y.tt is TT.THUNK else y for y in (x.R.L, x.R.R))
+        return self.cond(x.L), yes, no
+
+    def cond(self, x):
+        # Comparison tested directly, without going through 1 and 0
+        fn = head_name(x)
+        if fn in PY_COMPARISONS:
+            return f"{self.expr(x.L)} {PY_COMPARISONS[fn]} {self.expr(x.R)}"
+        return self.expr(x)
+
+    def is_self_call(self, x):
+        return head_name(x) == SELF_F and SELF_F not in self.params
+
+    def args(self, x):
+        # Each argument has to match the kind the body is specialized to
+        args = []
+        for y, kind in zip((x.L, x.R), self.kinds):
+            if kind is TT.UNIT:
+                if not (isinstance(y, Leaf) and y.tt is TT.UNIT):
+                    raise Uncompilable(y)
+                args.append("None")
+            else:
+                args.append(self.expr(y))
+        return ", ".join(args)
+
+
+def head_name(x):
+    if not isinstance(x, Tree):
+        return None
+    H = getattr(x.H, "source", x.H)
+    if isinstance(H, Leaf) and H.tt in (TT.PUNCTUATION, TT.SYMBOL) \
+            and isinstance(H.w, str):
+        return H.w
+    return None
+
+
+def specialize(func, kinds):
+    """ Compiled body of func for given operand kinds, False if it has
+    anything the Specializer doesn't cover.
+    """
+    try:
+        source = Specializer(func, kinds).source(func.body)
+    except Uncompilable:
+        return False
+    namespace = {}
+    exec(compile(source, "<specialized>", "exec"), namespace)
+    return namespace["compiled"]
+
+
+def run_hot(func, L, R):
+    """ Result of func applied to L and R by its compiled body, None to
+    interpret the call.
+    """
+    global compiled_calls
+    if num_ops_overrides:
+        # Compiled bodies assume builtin NUM ops and then
+        return None
+    kinds = (kind_of(L), kind_of(R))
+    if None in kinds:
+        return None
+    counts = hot_bodies.get(func.body)
+    if counts is None:
+        counts = hot_bodies[func.body] = {}
+    compiled = counts.get(kinds, 0)
+    if type(compiled) is int:
+        if compiled < HOT_CALLS:
+            counts[kinds] = compiled + 1
+            return None
+        compiled = counts[kinds] = specialize(func, kinds)
+    if compiled is False:
+        return None
+    try:
+        n = compiled(L.w, R.w)
+    except ZeroDivisionError:
+        # Interpreter raises the hb error. The body is pure, rerunning is safe
+        return None
+    except RecursionError:
+        # Too deep for Python stack, leave this function to the interpreter
+        counts[kinds] = False
+        return None
+    compiled_calls += 1
+    return mknum(n)
 
 
 def load(a, b, env, cstack):
@@ -165,9 +553,23 @@ def import_(a, b, env, cstack):
 
 
 def execute(a, b, env, cstack):
+    """ code execute () runs code, code execute fuel or
+    code execute (fuel : ms) runs it within a budget. () is no limit.
+    """
+    global active_budget
     assert a.tt in (TT.SYMBOL, TT.STRING)
     code = a.w
-    return Execute_(code, env, cstack)
+    if b.tt is TT.UNIT:
+        return Execute_(code, env, cstack)
+    fuel, ms = (b.L, b.R) if isinstance(b, Tree) and iscons(b.H) else (b, Unit)
+    outer = active_budget
+    active_budget = Budget(fuel.w if fuel.tt is TT.NUM else None,
+                           ms.w / 1000 if ms.tt is TT.NUM else None,
+                           outer=outer)
+    try:
+        return Execute_(code, env, cstack)
+    finally:
+        active_budget = outer
 
 
 def reset(a, b, env, cstack):
@@ -191,6 +593,7 @@ def shift(a, b, env, cstack):
     # env = Env(env)
     # So far continuation is just a pair of st and env
     continuation = Leaf(TT.CONTINUATION, (cc, env))
+    env.capture()
     #env.bind("cc", continuation)
 
     # New: let the cc binding take place in function object
@@ -199,6 +602,560 @@ def shift(a, b, env, cstack):
     return b, None, env, cstack
 
 
+class Generator:
+    """ Native generator. Its stack segment is resumed in place, because
+    the continuation captured by yield is never resumed twice.
+    """
+
+    def __init__(self, body, arg, env):
+        self.body = body
+        self.arg = arg
+        self.env = env
+        self.stack = None
+        self.started = False
+        self.done = False
+        self.yield_env = None
+        self.caller_env = None
+
+    def __str__(self):
+        return "<generator>"
+
+
+def make_gen(a, b, env, cstack):
+    if not is_function(a):
+        raise TypecheckError(f"gen: Expected function or thunk. Got '{a.tt}'")
+    return Leaf("generator", Generator(a, b, env)), None, env, cstack
+
+
+def gen_send(a, b, env, cstack):
+    gen = a.w
+    if gen.done or (gen.started and gen.stack is None):
+        # Exhausted, failed or already running
+        return Unit, None, env, cstack
+    gen.caller_env = env
+
+    if not gen.started:
+        gen.started = True
+        st = Stack(GEN_TAG)
+        st.gen = gen
+        st.push(Frame(CT.Generator, None, a, None, env))
+        cstack.sresume(st)
+        if gen.body.tt == TT.THUNK:
+            x = unwrap(gen.body)
+        else:
+            x = Tree(gen.arg, gen.body, Unit)
+        return x, None, gen.env, cstack
+
+    st, gen.stack = gen.stack, None
+    cstack.sresume(st)
+    return b, None, gen.yield_env, cstack
+
+
+def gen_yield(a, b, env, cstack):
+    if not any(st.tag == GEN_TAG for st in cstack.rope):
+        # Outside of native gen, let other tasks run
+        return task_yield(a, b, env, cstack)
+    st = cstack.spop(GEN_TAG)
+    gen = getattr(st, "gen", None)
+    if gen is None:
+        raise TypecheckError("yield: Not inside native gen")
+    gen.stack = st
+    gen.yield_env = env
+    return a, None, gen.caller_env, cstack
+
+
+def gen_toseq(a, b, env, cstack):
+    def items():
+        while True:
+            x, _, _, _ = Eval(Tree(a, Leaf(TT.SYMBOL, "next"), Unit), env, cstack)
+            # Finished, failed, or running already so next did nothing
+            if a.w.done or a.w.stack is None:
+                return
+            yield x
+    return Leaf("seq", Seq(items())), None, env, cstack
+
+
+class Task:
+    """ Green thread. A task owns a rope of stack segments, switching tasks
+    swaps ropes in Cactus. Main program becomes a task the first time it
+    has to wait.
+    """
+
+    def __init__(self, body, arg, env):
+        self.body = body
+        self.arg = arg
+        self.env = env
+        self.started = body is None
+        self.rope = None
+        # Parked task continues with resume in parked_env once woken
+        self.waiting = False
+        self.resume = None
+        self.parked_env = None
+        self.done = False
+        self.failed = False
+        self.result = Unit
+        self.joiners = []
+
+    def __str__(self):
+        return "<task>"
+
+
+class Channel:
+
+    def __init__(self, capacity):
+        # None is unbounded, send never blocks then
+        self.capacity = capacity
+        self.items = deque()
+        self.receivers = deque()
+        # (task, value) blocked on full channel
+        self.senders = deque()
+
+    def __str__(self):
+        return "<chan>"
+
+
+def current_task(cstack):
+    if cstack.task is None:
+        cstack.task = cstack.main = Task(None, None, None)
+    return cstack.task
+
+
+def wake(task, x, cstack):
+    task.waiting = False
+    task.resume = x
+    cstack.run_queue.append(task)
+
+
+def run_next(cstack):
+    """ Switch to next ready task. Returns (x, env) to go on with, None if
+    no task is ready or will be.
+    """
+    reactor = cstack.reactor
+    if reactor is not None and reactor.pending():
+        reactor.poll(cstack)
+        if not cstack.run_queue:
+            # Nested Evals don't get here, they block in park
+            if reactor.loop is not None:
+                raise Idle()
+            reactor.block(cstack)
+    if not cstack.run_queue:
+        return None
+    task = cstack.task = cstack.run_queue.popleft()
+    if not task.started:
+        task.started = True
+        st = Stack(TASK_TAG)
+        st.push(Frame(CT.Task, None, task, None, task.env))
+        cstack.rope = [st]
+        if task.body.tt == TT.THUNK:
+            return unwrap(task.body), task.env
+        # f spawn (x : y) runs x f y
+        L, R = task.arg, Unit
+        if isinstance(L, Tree) and iscons(L.H):
+            L, R = L.L, L.R
+        return Tree(L, task.body, R), task.env
+    cstack.rope, task.rope = task.rope, None
+    return task.resume, task.parked_env
+
+
+def nested(cstack):
+    """ Running in an Eval some builtin called, eg. each. Its Python
+    caller can't be left for another task. Outermost Eval has a Return
+    frame, or a Task frame when it runs a task
+    """
+    return sum(f.ct in (CT.Return, CT.Task) for f in cstack.frames()) > 1
+
+
+def cant_block(name, env, cstack):
+    msg = f"{name}: Can't wait for other tasks inside each, filter or toseq"
+    return Unit, Shift("error", Leaf(TT.STRING, msg)), env, cstack
+
+
+def park(env, cstack):
+    """ Suspend running task until something wakes it """
+    task = current_task(cstack)
+    task.waiting = True
+    if nested(cstack):
+        # Python caller can't be left, sleep here until its timer or job
+        # is done. Tasks it wakes meanwhile run later
+        reactor_of(cstack).block(cstack, task)
+        cstack.run_queue.remove(task)
+        return task.resume, env
+    task.rope, task.parked_env = cstack.rope, env
+    return run_next(cstack)
+
+
+def runnable(cstack):
+    """ Some task is ready or will be once its timer or job is done """
+    return cstack.run_queue or (cstack.reactor is not None and cstack.reactor.pending())
+
+
+def deadlock(name, env, cstack):
+    msg = f"{name}: Deadlock, no other task can run"
+    return Unit, Shift("error", Leaf(TT.STRING, msg)), env, cstack
+
+
+def task_done(task, x, failed, cstack):
+    """ Task body returned x or raised it. Returns (x, env) of the next
+    task to run.
+    """
+    task.done, task.failed, task.result = True, failed, x
+    if failed and not task.joiners:
+        print(f"Task failed: {x}", file=sys.stderr)
+    for joiner in task.joiners:
+        wake(joiner, Tree(x, Leaf(TT.SYMBOL, "raise"), Unit) if failed else x, cstack)
+    task.joiners = []
+
+    nxt = run_next(cstack)
+    if nxt is None:
+        # Main program waits on something nothing will do anymore
+        main = cstack.task = cstack.main
+        cstack.rope, main.rope = main.rope, None
+        main.waiting = False
+        msg = Leaf(TT.STRING, "Deadlock, no other task can run")
+        nxt = Tree(msg, Leaf(TT.SYMBOL, "raise"), Unit), main.parked_env
+    return nxt
+
+
+def spawn(a, b, env, cstack):
+    if not is_function(a):
+        raise TypecheckError(f"spawn: Expected function or thunk. Got '{a.tt}'")
+    task = Task(a, b, env)
+    env.capture()
+    cstack.run_queue.append(task)
+    return Leaf("task", task), None, env, cstack
+
+
+def task_yield(a, b, env, cstack):
+    if nested(cstack):
+        # Others run once it's back in the outermost Eval
+        return Unit, None, env, cstack
+    wake(current_task(cstack), Unit, cstack)
+    x, env = park(env, cstack)
+    return x, None, env, cstack
+
+
+def join(a, b, env, cstack):
+    task = a.w
+    if task.done:
+        if task.failed:
+            return Unit, Shift("error", task.result), env, cstack
+        return task.result, None, env, cstack
+    if not runnable(cstack) or task is cstack.task:
+        return deadlock("join", env, cstack)
+    if nested(cstack):
+        return cant_block("join", env, cstack)
+    task.joiners.append(current_task(cstack))
+    x, env = park(env, cstack)
+    return x, None, env, cstack
+
+
+def make_chan(a, b):
+    return Leaf("chan", Channel(a.w if a.tt == TT.NUM and a.w > 0 else None))
+
+
+def chan_send(a, b, env, cstack):
+    ch = a.w
+    while ch.receivers:
+        task = ch.receivers.popleft()
+        if task.waiting:
+            wake(task, b, cstack)
+            return Unit, None, env, cstack
+    if ch.capacity is None or len(ch.items) < ch.capacity:
+        ch.items.append(b)
+        return Unit, None, env, cstack
+    if not runnable(cstack):
+        return deadlock("send", env, cstack)
+    if nested(cstack):
+        return cant_block("send", env, cstack)
+    ch.senders.append((current_task(cstack), b))
+    x, env = park(env, cstack)
+    return x, None, env, cstack
+
+
+def chan_recv(a, b, env, cstack):
+    ch = a.w
+    if ch.items:
+        x = ch.items.popleft()
+        while ch.senders:
+            task, value = ch.senders.popleft()
+            if task.waiting:
+                ch.items.append(value)
+                wake(task, Unit, cstack)
+                break
+        return x, None, env, cstack
+    if not runnable(cstack):
+        return deadlock("recv", env, cstack)
+    if nested(cstack):
+        return cant_block("recv", env, cstack)
+    ch.receivers.append(current_task(cstack))
+    x, env = park(env, cstack)
+    return x, None, env, cstack
+
+
+class Idle(Exception):
+    """ No task can run before the event loop delivers a timer or I/O """
+
+
+# Threads running blocking reads for parked tasks
+io_executor = None
+
+
+def run_in_thread(fn):
+    global io_executor
+    if io_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        io_executor = ThreadPoolExecutor()
+    return io_executor.submit(fn)
+
+
+class Reactor:
+    """ Timers and background jobs tasks are parked on. When no task is
+    ready the scheduler blocks on it, or under ExecuteAsync raises Idle so
+    that the asyncio loop can run something else meanwhile.
+    """
+
+    def __init__(self):
+        # Heap of (deadline, seq, task, value to resume it with)
+        self.timers = []
+        self.seq = itertools.count()
+        # Future -> task waiting for its result
+        self.jobs = {}
+        self.loop = None
+
+    def pending(self):
+        return bool(self.timers or self.jobs)
+
+    def call_later(self, delay, task, x):
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.seq), task, x))
+
+    def submit(self, fn, task):
+        self.jobs[run_in_thread(fn)] = task
+
+    def poll(self, cstack):
+        """ Wake tasks whose timer is due or whose job is done """
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, task, x = heapq.heappop(self.timers)
+            wake(task, x, cstack)
+        for future in [f for f in self.jobs if f.done()]:
+            task = self.jobs.pop(future)
+            exc = future.exception()
+            if exc is None:
+                wake(task, future.result(), cstack)
+            else:
+                err = Leaf(TT.ERROR, str(exc))
+                wake(task, Tree(err, Leaf(TT.SYMBOL, "raise"), Unit), cstack)
+
+    def timeout(self):
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - time.monotonic())
+
+    def block(self, cstack, task=None):
+        """ Sleep until some task is ready, or task if given """
+        from concurrent.futures import wait, FIRST_COMPLETED
+        while task.waiting if task is not None else not cstack.run_queue:
+            if self.jobs:
+                wait(self.jobs, timeout=self.timeout(), return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(self.timeout())
+            self.poll(cstack)
+
+    async def idle(self, cstack):
+        """ Like block, but lets the event loop run other things """
+        import asyncio
+        while not cstack.run_queue:
+            if self.jobs:
+                await asyncio.wait([asyncio.wrap_future(f) for f in self.jobs],
+                                   timeout=self.timeout(),
+                                   return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(self.timeout())
+            self.poll(cstack)
+
+
+def reactor_of(cstack):
+    if cstack.reactor is None:
+        cstack.reactor = Reactor()
+    return cstack.reactor
+
+
+# Reductions Eval runs between budget checks
+BUDGET_CHECK = 1000
+
+
+class OutOfBudget(Exception):
+    """ Native op would go over the budget, becomes hb error """
+
+
+class Suspended(Exception):
+    """ Time slice is used up. Execute with resume=True goes on with it """
+
+
+class Budget:
+    """ Limits of one Execute. Fuel is a number of reductions, deadline a
+    time.monotonic() it has to be done by. Native vector ops charge fuel
+    per item they make. With slice, Execute raises Suspended after that
+    many reductions, so that a scheduler can run something else meanwhile.
+    A nested execute spends its outer budget too.
+    """
+
+    def __init__(self, fuel=None, seconds=None, slice=None, outer=None):
+        self.fuel = fuel
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+        self.slice = slice
+        self.left = slice
+        self.outer = outer
+
+    def spend(self, n):
+        """ Take n reductions. Returns why budget ran out, None if it didn't """
+        b = self
+        while b is not None:
+            if b.fuel is not None:
+                b.fuel -= n
+                if b.fuel < 0:
+                    return "Out of fuel"
+            if b.deadline is not None and time.monotonic() > b.deadline:
+                return "Deadline exceeded"
+            b = b.outer
+        return None
+
+
+# Budget of the running Execute, None is unlimited
+active_budget = None
+
+
+def charge(n):
+    """ Spend n reductions before doing n items of native work """
+    if active_budget is not None:
+        msg = active_budget.spend(n)
+        if msg is not None:
+            raise OutOfBudget(msg)
+
+
+def metered(it):
+    """ Iterator charging fuel for what it yields, for infinite seqs """
+    if active_budget is None:
+        return it
+    return itertools.chain.from_iterable(
+        charge(len(chunk)) or chunk
+        for chunk in iter(lambda: list(itertools.islice(it, BUDGET_CHECK)), []))
+
+
+def check_budget(x, env, cstack):
+    """ Eval ran BUDGET_CHECK reductions and goes on with x next. Returns
+    (x, env) to go on with, raises Suspended at end of a time slice.
+    """
+    budget = active_budget
+    msg = budget.spend(BUDGET_CHECK)
+    if msg is not None:
+        # Stays exhausted, a handler looping on gets the error again
+        return raise_value(Leaf(TT.ERROR, msg), env, cstack)
+    if budget.slice is not None:
+        budget.left -= BUDGET_CHECK
+        # Only the outermost Eval can be left. Next check after nested ones
+        # return suspends then
+        if budget.left <= 0 and not nested(cstack):
+            budget.left = budget.slice
+            task = current_task(cstack)
+            task.rope, task.parked_env = cstack.rope, env
+            # Back of the queue, other ready tasks go first
+            wake(task, x, cstack)
+            raise Suspended()
+    return x, env
+
+
+class LoopState:
+    """ Mutable state of one native loop. Lives in the loop's CT.Loop frame,
+    which is re-pushed every iteration, so iterations don't allocate envs.
+    """
+
+    def __init__(self, cond, body, it, var, env):
+        self.cond = cond
+        self.body = body
+        self.it = it
+        self.var = var
+        self.env = env
+        self.in_body = cond is None
+        self.last = Unit
+
+    def step(self, x):
+        """ Consume result of last cond/body evaluation. Returns next
+        expression to evaluate or None when the loop is over.
+        """
+        if not self.in_body:
+            if x.tt == TT.NUM and x.w == 0:
+                return None
+            self.in_body = True
+            return self.body
+
+        self.last = x
+        if self.cond is not None:
+            self.in_body = False
+            return self.cond
+        if self.it is not None:
+            item = next(self.it, None)
+            if item is None:
+                return None
+            self.env.bind(self.var, item)
+        return self.body
+
+
+def loop_body(b, env):
+    """ Loop body, env to run it in and name of loop variable """
+    if b.tt in (TT.FUNTHUNK, TT.FUNCTION):
+        func = makefunc_(b, env).w if b.tt == TT.FUNTHUNK else b.w
+        env = Env(func.env)
+        env.bind(func.right_name, Unit)
+        return func.body, env, func.left_name
+    return unwrap(b), env, None
+
+
+def start_loop(state, env, cstack):
+    x = state.step(Unit) if state.in_body else state.cond
+    if x is None:
+        return Unit, None, env, cstack
+    cstack.push(Frame(CT.Loop, None, state, None, env))
+    return x, None, state.env, cstack
+
+
+def loop_(a, b, env, cstack):
+    body, body_env, _ = loop_body(a, env)
+    return start_loop(LoopState(None, body, None, None, body_env), env, cstack)
+
+
+def while_(a, b, env, cstack):
+    body, body_env, _ = loop_body(b, env)
+    cond = unwrap(a)
+    return start_loop(LoopState(cond, body, None, None, body_env), env, cstack)
+
+
+def iter_items(a):
+    if a.tt == "range":
+        return (Leaf(TT.NUM, x) for x in range_to_range(a.w))
+    if a.tt == TT.NUM:
+        return (Leaf(TT.NUM, x) for x in range(a.w))
+    return hmap.items_of(a)
+
+
+def for_(a, b, env, cstack):
+    body, body_env, var = loop_body(b, env)
+    state = LoopState(None, body, iter_items(a), var or "x", body_env)
+    return start_loop(state, env, cstack)
+
+
+def break_(a, b, env, cstack):
+    cstack.unwind(CT.Loop)
+    cstack.pop()
+    return a, None, env, cstack
+
+
+def continue_(a, b, env, cstack):
+    # Loop frame takes () as result of the body and goes on
+    cstack.unwind(CT.Loop)
+    return Unit, None, env, cstack
+
+
 def setenv(H, env):
     self_f = env.lookup(SELF_F, None)
     if self_f is H:
@@ -232,8 +1189,8 @@ def if_(a, b):
 
 def app(a, b):
     if a.tt == "vec":
-        return Leaf("vec", a.w + [b.w])
-    return Leaf("vec", [a.w, b.w])
+        return Leaf("vec", a.w.conj(b.w))
+    return mkvec([a.w, b.w])
 
 
 def print_fn(a, _):
@@ -241,10 +1198,12 @@ def print_fn(a, _):
     return a
 
 
-def wait(a, b):
+def wait(a, b, env, cstack):
     assert b.tt == TT.NUM and b.w >= 0
-    time.sleep(b.w)
-    return a
+    # Other tasks run meanwhile, the sleeping one resumes with a
+    reactor_of(cstack).call_later(b.w, current_task(cstack), a)
+    x, env = park(env, cstack)
+    return x, None, env, cstack
 
 
 def set_dispatch(a, b, env):
@@ -268,7 +1227,7 @@ def set_dispatch(a, b, env):
 
 
 def new_object(a, b):
-    return Leaf(TT.OBJECT, Env(None))
+    return Leaf(TT.OBJECT, Record(None))
 
 
 def at(a, b, env, cstack):
@@ -300,10 +1259,6 @@ def at(a, b, env, cstack):
     return item, None, env, cstack
 
 
-class TypecheckError(Exception):
-    pass
-
-
 def nominal_typecheck(checked_type, expected_type):
     if str(checked_type) != str(expected_type):
         raise TypecheckError(f"Typecheck failed. '{checked_type}' doesn't match expected '{expected_type}'")
@@ -332,7 +1287,8 @@ def construct(a, b):
 
 
 def eq(a, b):
-    result = 1 if a.tt == b.tt and a.w == b.w else 0
+    # Structural, so that trees and vecs compare by value
+    result = 1 if hmap.hb_eq(a, b) else 0
     return Leaf(TT.NUM, result)
 
 
@@ -370,20 +1326,98 @@ def next_ins(x):
     raise AssertionError(f"Result needs to be either Leaf or Tree. Got '{type(x)}'")
 
 
+def span_of(x, depth=64):
+    """ Source span of x. Eval doesn't track spans of results, they're
+    computed here when an error needs them from the parsed nodes x is made
+    of. Computed leaves have no span.
+    """
+    if x is None or x is Unit:
+        return None
+    if x.debug is not None or not isinstance(x, Tree) or depth == 0:
+        return x.debug
+    spans = [s for s in (span_of(y, depth - 1) for y in (x.L, x.H, x.R))
+             if s is not None]
+    if not spans:
+        return None
+    return DebugInfo(spans[0].start, spans[-1].end, spans[0].lineno)
+
+
+def error_span(err, cstack):
+    """ Span of error's witness or of the innermost pending expression """
+    span = span_of(err.witness)
+    if span is not None:
+        return span
+    for frame in cstack.frames():
+        if frame.L is not None:
+            span = span_of(Tree(frame.L, frame.H, frame.R))
+            if span is not None:
+                return span
+    return None
+
+
 def hb_shift(tag, value):
     tag = Leaf(TT.SYMBOL, tag, debug=value.debug)
     return Tree(tag, Leaf(TT.SYMBOL, "shift"), value)
 
 
-def Eval(x, env, cstack):
-    # Stack of continuations
-    cstack.push(Frame(CT.Return, None, None, None, env))
+def catch(a, b, env, cstack):
+    # Protected region costs one marker frame, nothing is captured
+    if b.tt == TT.TREE and iscons(b.H):
+        match, handler = str(b.L.w), b.R
+    else:
+        match, handler = None, b
+    cstack.push(Frame(CT.Handler, match, handler, None, env))
+    return unwrap(a), None, env, cstack
+
+
+def raise_(a, b, env, cstack):
+    return Unit, Shift("error", a), env, cstack
+
+
+def raise_value(value, env, cstack):
+    """ Jump to the nearest handler matching value. Falls back to shifting
+    to 'error' reset when one of those is closer, eg. lib/errors.hb catch.
+    """
+    tt = str(TT.TREE if isinstance(value, Tree) else value.tt)
+    while True:
+        frame = cstack.find(CT.Handler, lambda f: f.L is None or f.L == tt, "error")
+        if frame is None:
+            return hb_shift("error", value), env
+        cstack.unwind_past(frame)
+        if frame.ct == CT.Handler:
+            return Tree(value, frame.H, Unit), frame.env
+        if frame.ct == CT.Return:
+            # Leave nested Eval, its caller continues raising
+            raise Raised(value)
+        if frame.ct == CT.Task:
+            # Task failed, whoever joins it gets the error
+            return task_done(frame.H, value, True, cstack)
+        # Generator failed, keep raising in whoever resumed it
+        gen = frame.H.w
+        gen.done = True
+        env = gen.caller_env
+
+
+def Eval(x, env, cstack, resume=False):
+    # Stack of continuations. Resumed Eval goes on with Return frame of the
+    # one that raised Idle
+    if not resume:
+        cstack.push(Frame(CT.Return, None, None, None, env))
     # Stored instruction pointer
     ins = next_ins(x)
+    # Reductions left before budget check
+    ticks = BUDGET_CHECK
 
     while True:
         if ins >= CT.Tree:
             if ins == CT.Tree:
+                ticks -= 1
+                if not ticks:
+                    ticks = BUDGET_CHECK
+                    if active_budget is not None:
+                        x, env = check_budget(x, env, cstack)
+                        ins = next_ins(x)
+                        continue
                 L, H, R = x.L, x.H, x.R
             if ins < CT.Left and isinstance(L, Tree):
                 cstack.push(Frame(CT.Left, L, H, R, env))
@@ -394,7 +1428,7 @@ def Eval(x, env, cstack):
                 x, ins = H, next_ins(H)
                 continue
             # print("H", type(H), H)
-            if H.tt == TT.SEPARATOR:
+            if H.tt is TT.SEPARATOR:
                 # Tail recurse on separator '|' before R gets evaluated
                 x, ins = R, next_ins(R)
                 continue
@@ -408,23 +1442,29 @@ def Eval(x, env, cstack):
 #            print("R", R, R.debug, file=sys.stderr)
 
 
-            new_debug = DebugInfo(L.debug.start, R.debug.end, L.debug.lineno) \
-                        if L.debug and R.debug else None
-            #new_debug = DebugInfo(L.debug.start, R.debug.end, L.debug.lineno)
-
             # TODO reorder by frequency of invocation. BUILTIN to top?
-            if H.tt == TT.UNIT:
+            if L.tt is TT.NUM and R.tt is TT.NUM \
+                    and (H.tt is TT.PUNCTUATION or H.tt is TT.SYMBOL) \
+                    and H.w in NUM_OPS and not num_ops_overrides \
+                    and type(L.w) is int and type(R.w) is int \
+                    and (R.w != 0 or H.w not in ("/", "mod")):
+                # Unboxed NUM op NUM, skips dispatch and the BUILTIN call.
+                # Division by zero takes the slow path to raise hb error
+                x = mknum(NUM_OPS[H.w](L.w, R.w))
+            elif H.tt is TT.UNIT:
                 x = H
-                x.debug = new_debug
-            elif H.tt == TT.CONTINUATION:
+            elif H.tt is TT.CONTINUATION:
                 cc, env = H.w     # unwrap continuation and captured environment
                 cstack.scopy(cc)  # Copy over its stack onto newly created stack
                 x, ins = L, next_ins(L)
-                x.debug = new_debug
             elif iscons(H):
                 x = Tree(L, H, R)
-                x.debug = new_debug
-            elif H.tt == TT.BUILTIN:
+            elif H.tt is TT.BUILTIN:
+                if overridden and type(H) is StaticOp and H.source.w in overridden:
+                    # Resolved ahead of time, rebound since
+                    H = H.source
+                    ins = CT.Right
+                    continue
                 try:
                     x = H.w(L, R)
                 except Exception as exc:
@@ -436,60 +1476,84 @@ def Eval(x, env, cstack):
                     if isinstance(exc, AssertionError):
                         raise
                     #print("RROR", type(exc), str(exc), file=sys.stderr)
-                    x = hb_shift("error", Leaf(TT.ERROR, str(exc), debug=new_debug))
+                    err = Leaf(TT.ERROR, str(exc), debug=span_of(Tree(L, H, R)))
+                    x, env = raise_value(err, env, cstack)
 
                 ins = next_ins(x)
-                x.debug = new_debug
                 continue
-            elif H.tt == TT.SPECIAL:
-                x, shift, env, cstack = H.w(L, R, env, cstack)
+            elif H.tt is TT.SPECIAL:
+                if overridden and type(H) is StaticOp and H.source.w in overridden:
+                    H = H.source
+                    ins = CT.Right
+                    continue
+                try:
+                    x, shift, env, cstack = H.w(L, R, env, cstack)
+                except Raised as exc:
+                    # Unhandled in nested Eval (eg. inside each), go on here
+                    x, shift = Unit, Shift("error", exc.value)
 
                 # Capture shift tag and value from shift channel, wrap it with
                 # TT.ERROR and continue with this error continuation to next
                 # eval iteration
                 if shift is not None:
                     assert isinstance(shift, Shift)
-                    x = hb_shift(shift.tag, shift.value)
+                    if shift.tag == "error":
+                        x, env = raise_value(shift.value, env, cstack)
+                    else:
+                        x = hb_shift(shift.tag, shift.value)
 
                 ins = next_ins(x)
-                x.debug = new_debug
                 continue
-            elif H.tt == TT.FUNTHUNK:
-                x = Tree(L, Tree(H, Leaf(TT.SYMBOL, "func"), Unit), R)
+            elif H.tt is TT.FUNTHUNK:
+                # Small helpers run in place, without frame and env
+                x = inline(H, L, R)
+                if x is None:
+                    # Called right away, it holds on to env only through
+                    # the callee's env, which is captured if anything is
+                    x = Tree(L, makefunc_(H, env, capture=False), R)
                 ins = next_ins(x)
-                x.debug = H.debug
                 continue
-            elif H.tt == TT.THUNK:
+            elif H.tt is TT.THUNK:
                 x = unwrap(H)
                 ins = next_ins(x)
-                x.debug = new_debug # TODO really this way? Or just grab debug from H itself?
                 continue
-            elif H.tt == TT.FUNCTION:
+            elif H.tt is TT.FUNCTION:
                 func = H.w
-
-                # Tail optimize cstack and env if the last frame would
-                # be effectively the same as the new one
-                self_h = env.lookup(SELF_F, None)
-                last_frame = cstack.peek()
-                if (last_frame and last_frame.ct != CT.Function) \
-                    or self_h is not H:
-                    # TODO compare self_h == H or self_h.func == func?
-                    cstack.push(Frame(CT.Function, L, H, R, env))
-
-                    # Set up func's original env -> lexical scoping
-                    env = func.env
-                    env = Env(env)
-                # print(TT.OBJECT, id(env))
-
-                env.bind(func.left_name, L)
-                env.bind(SELF_F, H)
-                env.bind(func.right_name, R)
-                x = func.body
-                ins = next_ins(x)
-
-                x.debug = new_debug
-                continue
-            elif H.tt == TT.TREE and iscons(H.H):
+                # Compiled bodies don't count reductions, budgeted code is
+                # always interpreted
+                result = run_hot(func, L, R) \
+                    if HOT_CALLS and active_budget is None else None
+                if result is None:
+                    # Eval pushes a frame for every pending subexpression, so
+                    # if caller's Function frame is on top, nothing is left to
+                    # do after this call returns - it's a tail call, whichever
+                    # function it calls. Don't push another frame then.
+                    last_frame = cstack.peek()
+                    if last_frame is None or last_frame.ct != CT.Function:
+                        cstack.push(Frame(CT.Function, L, H, R, env))
+
+                        # Set up func's original env -> lexical scoping
+                        env = Env(func.env)
+                    elif env.captured or (env.e.get(SELF_F) is not H
+                                          and func.env is not env):
+                        # Tail call, caller's frame does for this one. Its
+                        # env may live on in a closure, so it isn't reused
+                        env = Env(func.env)
+                    # Tail call to self or to a FUNTHUNK called from here,
+                    # from an env nothing closed over, rebinds params in it.
+                    # The chain doesn't grow with mutual recursion.
+                    # print(TT.OBJECT, id(env))
+
+                    env.bind(func.left_name, L)
+                    env.bind(SELF_F, H)
+                    env.bind(func.right_name, R)
+                    x = func.body
+                    ins = next_ins(x)
+
+                    continue
+                # Hot body ran compiled
+                x = result
+            elif H.tt is TT.TREE and iscons(H.H):
                 path, fn = tree2env(H, env)
                 fn_env = path2env(path, env)
                 op = fn_env.lookup(fn, None)
@@ -499,9 +1563,8 @@ def Eval(x, env, cstack):
                                  TT.FUNCTION, TT.BUILTIN, TT.THUNK, TT.FUNTHUNK)
                 H = op
                 ins = CT.Right
-                x.debug = new_debug
                 continue
-            elif H.tt == TT.OBJECT:
+            elif H.tt is TT.OBJECT:
                 # If module given for dispatch,
                 # lookup a constructor "." function on it.
                 # "." reserved for constructors
@@ -514,21 +1577,21 @@ def Eval(x, env, cstack):
                                 TT.FUNCTION, # TT.CLOSURE,
                                 TT.BUILTIN, TT.THUNK, TT.FUNTHUNK, TT.SYMBOL)
                 ins = CT.Right
-                x.debug = new_debug
                 continue
             elif H.tt in (TT.PUNCTUATION, TT.SYMBOL,
                           TT.STRING, TT.SEPARATOR):
                 H = dispatch(H, L.tt, R.tt, env)
                 ins = CT.Right
-                x.debug = new_debug
                 continue
-            #elif H.tt == TT.CLOSURE:
+            #elif H.tt is TT.CLOSURE:
             #    cstack.push(Frame(CT.Function, L, H, R, env))
             #    env, H = H.w
             #    ins = CT.Right
             #    continue
             else:
-                raise CantReduce(f"Can't reduce node: {H} of {H.tt}", H)
+                # Computed head has no span, point at the whole node then
+                witness = H if H.debug is not None else Tree(L, H, R)
+                raise CantReduce(f"Can't reduce node: {H} of {H.tt}", witness)
 #
 #         # Capture current environment and close over it
 #         if isinstance(x, Leaf) and x.tt == TT.FUNCTION:
@@ -544,6 +1607,39 @@ def Eval(x, env, cstack):
         # print("Restore", L, H, R, c.ct.name, id(env), env)
         if c.ct == CT.Function:
             ins = next_ins(x)
+        elif c.ct == CT.Generator:
+            # Generator body finished, return to whoever resumed it
+            gen = H.w
+            gen.done = True
+            x, env = Unit, gen.caller_env
+            ins = next_ins(x)
+        elif c.ct == CT.Task:
+            x, env = task_done(H, x, False, cstack)
+            ins = next_ins(x)
+        elif c.ct == CT.Iter:
+            x, state = H.step(x)
+            if state is not None:
+                cstack.push(Frame(CT.Iter, None, state, None, env))
+                env = state.env
+            ins = next_ins(x)
+        elif c.ct == CT.Loop:
+            state = H
+            nxt = state.step(x)
+            if nxt is None:
+                x = state.last
+            else:
+                cstack.push(c)
+                x, env = nxt, state.env
+                # Iterations of a body that is a plain value count too
+                ticks -= 1
+                if not ticks:
+                    ticks = BUDGET_CHECK
+                    if active_budget is not None:
+                        x, env = check_budget(x, env, cstack)
+            ins = next_ins(x)
+        elif c.ct == CT.Handler:
+            # Protected region finished without raising
+            ins = next_ins(x)
         elif c.ct == CT.Left:
             L = x
         elif c.ct == CT.Head:
@@ -607,23 +1703,133 @@ def right(a, b, env):
     return b
 
 
+class IterState:
+    """ State of a higher-order builtin run by the evaluator instead of a
+    nested Eval. Every step makes a new state in a new CT.Iter frame, so a
+    continuation captured inside the body can be resumed more than once.
+
+    Subclasses define step(x): consume result of last step (None at
+    start), return (expression, next state) to go on or (result, None)
+    when done.
+    """
+
+    __slots__ = ("env",)
+
+    def __init__(self, env):
+        self.env = env
+
+
+def start_iter(state, env, cstack):
+    x, state = state.step(None)
+    if state is None:
+        return x, None, env, cstack
+    cstack.push(Frame(CT.Iter, None, state, None, env))
+    return x, None, state.env, cstack
+
+
+def item_at(xs, i):
+    """ Item i of indexable xs or next item of iterator xs (i is None) """
+    if i is None:
+        return next(xs, None)
+    if i < len(xs):
+        return xs[i]
+    return None
+
+
+class FoldState(IterState):
+    # Lazy seqs are iterated in place, so only indexable ones are multi-shot
+
+    __slots__ = ("xs", "i", "f", "acc")
+
+    def __init__(self, xs, i, f, acc, env):
+        super().__init__(env)
+        self.xs = xs
+        self.i = i
+        self.f = f
+        self.acc = acc
+
+    def step(self, x):
+        acc = self.acc if x is None else x
+        item = item_at(self.xs, self.i)
+        if item is None:
+            return acc, None
+        i = None if self.i is None else self.i + 1
+        return Tree(acc, self.f, item), FoldState(self.xs, i, self.f, acc, self.env)
+
+
+class EachState(IterState):
+
+    __slots__ = ("xs", "i", "f", "R", "out", "wrap", "chunk", "start")
+
+    def __init__(self, xs, i, f, R, out, wrap, env, chunk=(), start=0):
+        super().__init__(env)
+        self.xs = xs
+        self.i = i
+        self.f = f
+        self.R = R
+        # Results so far as cons list (last, (previous, ...)), shared by
+        # the states of one run instead of copied
+        self.out = out
+        self.wrap = wrap
+        # Leaf of xs item i is in and index of its first item
+        self.chunk = chunk
+        self.start = start
+
+    def step(self, x):
+        out = self.out if x is None else (x, self.out)
+        if self.i == len(self.xs):
+            v = []
+            while out is not None:
+                x, out = out
+                v.append(x)
+            return mkvec(v[::-1]), None
+        chunk, start = self.chunk, self.start
+        if self.i - start >= len(chunk):
+            # Vec is walked down once per leaf, not per item
+            chunk, start = self.xs.leaf(self.i) if type(self.xs) is pvec.PVec \
+                else (self.xs, 0)
+        item = self.wrap(chunk[self.i - start])
+        return Tree(item, self.f, self.R), \
+            EachState(self.xs, self.i + 1, self.f, self.R, out, self.wrap, self.env,
+                      chunk, start)
+
+
+class ThenState(IterState):
+    """ Evaluate one expression, then hand its result to done """
+
+    __slots__ = ("x", "done")
+
+    def __init__(self, x, done, env):
+        super().__init__(env)
+        self.x = x
+        self.done = done
+
+    def step(self, x):
+        if x is None:
+            return self.x, self
+        return self.done(x), None
+
+
 def fold(a, b, env, cstack):
+    # Lazy seqs are consumed one by one so that they fold in constant memory
+    xs = a.w
+    i = 0 if hasattr(xs, "__getitem__") else None
+    if i is None:
+        xs = iter(xs)
     if b.tt == TT.TREE:
         f, R = b.L, b.R
 
         acc = R
-        xs = a.w
     else:
         f, R = b, Unit
 
-        if len(a.w) == 0:
-            return R
-        acc = a.w[0]
-        xs = a.w[1:]
+        acc = item_at(xs, i)
+        if acc is None:
+            return R, None, env, cstack
+        if i is not None:
+            i += 1
 
-    for x in xs:
-        acc, _, _, _ = Eval(Tree(acc, f, x), env, cstack)
-    return acc, None, env, cstack
+    return start_iter(FoldState(xs, i, f, acc, env), env, cstack)
 
 
 # def num_fold(a, b):
@@ -654,6 +1860,9 @@ def fold(a, b, env, cstack):
 
 def num_fold(a, b):
     op = b.w
+    x = parallel.par_reduce(a.w, op) if op in parallel.COMBINE else None
+    if x is not None:
+        return Leaf(TT.NUM, x)
 
     op = {
         "+": lambda a, b: a + b,
@@ -675,6 +1884,9 @@ def num_fold_by(a, b):
     arr = a.w
     key = b.L.w
     op = b.R.w
+    acc = parallel.par_fold_by(arr, key, op)
+    if acc is not None:
+        return Leaf("num_vec", acc)
 
     op = {
         "+": lambda a, b: a + b,
@@ -720,7 +1932,21 @@ def scan(a, b):
     for x in a.w:
         acc = op(acc, x)
         r += [acc]
-    return Leaf("vec", r)
+    return mkvec(r)
+
+
+# Shared NUM leaves for small ints, results of arithmetic and comparisons
+SMALL_NUMS = [Leaf(TT.NUM, n) for n in range(-5, 257)]
+
+
+def mknum(n):
+    if -5 <= n <= 256:
+        return SMALL_NUMS[n + 5]
+    return Leaf(TT.NUM, n)
+
+
+def mkvec(xs):
+    return Leaf("vec", pvec.PVec.from_list(xs))
 
 
 def each_prep(b):
@@ -734,14 +1960,143 @@ def each_prep(b):
 
 def each(a, b, env, cstack):
     f, R = each_prep(b)
-    v = [Eval(Tree(x, f, R), env, cstack)[0] for x in a.w]
-    return Leaf("vec", v), None, env, cstack
+    state = EachState(a.w, 0, f, R, None, lambda x: x, env)
+    return start_iter(state, env, cstack)
 
 
 def num_each(a, b, env, cstack):
     f, R = each_prep(b)
-    v = [Eval(Tree(Leaf(TT.NUM, x), f, R), env, cstack)[0] for x in a.w]
-    return Leaf("vec", v), None, env, cstack
+    state = EachState(a.w, 0, f, R, None, lambda x: Leaf(TT.NUM, x), env)
+    return start_iter(state, env, cstack)
+
+
+# Worker processes of peach, set by -j. None is one per core
+JOBS = None
+# Shorter vectors aren't worth shipping to workers
+PEACH_MIN = 1000
+# Chunks per worker, evens out items of uneven cost
+PEACH_CHUNKS = 4
+
+# Tells peach calls apart, workers are shared by all of them
+peach_calls = itertools.count()
+# (call, (env, function)) a peach worker decoded last
+peach_worker = None
+
+
+def peach_chunk(task):
+    """ Worker side: encoded results of the function on a chunk """
+    global peach_worker
+    call, payload, overrides, data = task
+    if peach_worker is None or peach_worker[0] != call:
+        try:
+            peach_worker = call, get_codec().loads(payload)
+        except Exception:
+            peach_worker = None
+            return None
+        if overrides:
+            # Decoded envs get their bindings without Env.bind
+            override_all()
+    env, b = peach_worker[1]
+    try:
+        xs = get_codec().loads(data)
+        x, _, _, _ = Eval(Tree(xs, Leaf(TT.SYMBOL, "each"), b), Env(env), Cactus(ROOT_TAG))
+        if x.tt != "vec":
+            return None
+        return get_codec().dumps(list(x.w))
+    except Exception:
+        # hb errors don't pickle, parent reruns serially to raise them
+        return None
+
+
+def peach(a, b, env, cstack):
+    """ each split across worker processes. Meant for pure functions:
+    effects happen in workers and the call may run again serially.
+    """
+    serial_each = num_each if a.tt == "num_vec" else each
+    jobs = JOBS or os.cpu_count() or 1
+    xs = a.w
+    if jobs <= 1 or len(xs) < PEACH_MIN:
+        return serial_each(a, b, env, cstack)
+
+    codec = get_codec()
+    try:
+        # Function with its captured env, decoded once per worker
+        payload = codec.dumps((env, b))
+    except serial.CodecError:
+        return serial_each(a, b, env, cstack)
+    size = -(-len(xs) // (jobs * PEACH_CHUNKS))
+    call = next(peach_calls)
+    tasks = [(call, payload, num_ops_overrides, codec.dumps(Leaf(a.tt, xs[i:i + size])))
+             for i in range(0, len(xs), size)]
+
+    try:
+        parts = parallel.pool(jobs).map(peach_chunk, tasks)
+    except Exception:
+        parts = [None]
+    if None in parts:
+        # Serial run raises the error the usual way
+        return serial_each(a, b, env, cstack)
+
+    out = []
+    for part in parts:
+        out.extend(codec.loads(part))
+    return mkvec(out), None, env, cstack
+
+
+def open_stream(filename, mode):
+    # Pick decompressor by suffix
+    if filename.endswith(".gz"):
+        import gzip
+        return gzip.open(filename, mode)
+    if filename.endswith(".bz2"):
+        import bz2
+        return bz2.open(filename, mode)
+    if filename.endswith((".xz", ".lzma")):
+        import lzma
+        return lzma.open(filename, mode)
+    return open(filename, mode)
+
+
+def read_lines(filename):
+    with open_stream(filename, "rt") as f:
+        for line in f:
+            yield Leaf(TT.STRING, line.rstrip("\r\n"))
+
+
+def read_chunks(filename, mode, size):
+    tt = TT.STRING if mode == "rt" else "bytes"
+    with open_stream(filename, mode) as f:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                break
+            yield Leaf(tt, chunk)
+
+
+def chunk_size(b, default):
+    if b.tt == TT.UNIT:
+        return default
+    if b.tt != TT.NUM or b.w <= 0:
+        raise TypecheckError(f"Chunk size must be positive NUM. Got '{b.tt}'")
+    return b.w
+
+
+def seq_each(a, b, env, cstack):
+    f, R = each_prep(b)
+    xs = (Eval(Tree(x, f, R), env, cstack)[0] for x in a.w)
+    return Leaf("seq", Seq(xs)), None, env, cstack
+
+
+def seq_filter(a, b, env, cstack):
+    f, R = each_prep(b)
+    xs = (x for x in a.w if Eval(Tree(x, f, R), env, cstack)[0].w != 0)
+    return Leaf("seq", Seq(xs)), None, env, cstack
+
+
+def seq_drain(a, b):
+    for _ in metered(a.w):
+        pass
+    return Unit
 
 
 def arithmetic_series_sum(a, b, by):
@@ -755,16 +2110,16 @@ def asmod_vec(a, b, env, cstack):
         assert item.tt == TT.TREE
         assert item.L.tt in (TT.SYMBOL, TT.STRING)
         d[item.L.w] = item.R
-    return Leaf(TT.OBJECT, Env(env, from_dict=d)), None, env, cstack
+    return Leaf(TT.OBJECT, Record(env, from_dict=d)), None, env, cstack
 
 def asmod_tree(a, b, env, cstack):
     assert a.L.tt in (TT.SYMBOL, TT.STRING)
     d = {a.L.w: a.R}
-    return Leaf(TT.OBJECT, Env(env, from_dict=d)), None, env, cstack
+    return Leaf(TT.OBJECT, Record(env, from_dict=d)), None, env, cstack
 
 
 def zip_(a, b):
-    return Leaf(a.tt, [Tree(x, Leaf(TT.PUNCTUATION, ":"), y) for x, y in zip(a.w, b.w)])
+    return mkvec([Tree(x, Leaf(TT.PUNCTUATION, ":"), y) for x, y in zip(a.w, b.w)])
 
 
 def order(a, b):
@@ -776,13 +2131,15 @@ def choose(a, b):
     for i, pos in enumerate(b.w):
         # TODO handle out of bounds
         new[i] = a.w[pos]
+    if a.tt == "vec":
+        return mkvec(new)
     return Leaf(a.tt, new)
 
 
 def tap(a, b, env, cstack):
     # Just for side effect
-    Eval(Tree(a, b, Unit), env, cstack)
-    return a, None, env, cstack
+    state = ThenState(Tree(a, b, Unit), lambda _: a, env)
+    return start_iter(state, env, cstack)
 
 
 class Some:
@@ -817,7 +2174,8 @@ def json_each(filename, fn):
     with open(filename, "r") as f:
         for item in f:
             item = json.loads(item)
-            item = Leaf(TT.NATIVE_OBJECT, Env(None, from_dict=item))
+            # Records with same keys share one shape
+            item = Leaf(TT.NATIVE_OBJECT, Record(None, from_dict=item))
             item = Tree(item, fn, Unit)
 
             env = prepare_env()
@@ -835,43 +2193,60 @@ def add_type(x):
         t = TT.STRING
     elif isinstance(x, int):
         t = TT.NUM
+    elif isinstance(x, dict):
+        return Leaf(TT.NATIVE_OBJECT, Record(None, from_dict=x))
     else:
         raise TypecheckError(f"Can't add type to native type {type(x).__name__} ")
     return Leaf(t, x)
 
 
+def writable(mod):
+    if getattr(mod, "shared", False):
+        raise TypecheckError("Can't change shared module, merge it into a new one")
+    return mod
+
+
 def mod_assign(a, b):
-    a.w.bind(b.L.w, b.R)
+    writable(a.w).bind(b.L.w, b.R)
     return a
 
 
 def mod_update(a, b, env, cstack):
+    writable(a.w)
     value = add_type(a.w.lookup(b.L.w, Unit))
     update_fn = b.R
-    value, _, _, _ = Eval(Tree(value, update_fn, Unit), env, cstack)
-    a.w.bind(b.L.w, value)
-    return a, None, env, cstack
+
+    def done(value):
+        a.w.bind(b.L.w, value)
+        return a
+
+    state = ThenState(Tree(value, update_fn, Unit), done, env)
+    return start_iter(state, env, cstack)
 
 
 def ptr_update(a, b, env, cstack):
     mod_, at_ = a.w
-    mod, at = mod_.w, at_.w
+    mod, at = writable(mod_.w), at_.w
     value = add_type(mod.lookup(at, Unit))
     update_fn = b
-    value, _, _, _ = Eval(Tree(value, update_fn, Unit), env, cstack)
-    mod.bind(at, value)
-    return a, None, env, cstack
+
+    def done(value):
+        mod.bind(at, value)
+        return a
+
+    state = ThenState(Tree(value, update_fn, Unit), done, env)
+    return start_iter(state, env, cstack)
 
 
 def ptr_set(a, b):
     mod_, at_ = a.w
-    mod, at = mod_.w, at_.w
+    mod, at = writable(mod_.w), at_.w
     mod.bind(at, b)
     return a
 
 
 def mod_merge(a, b):
-    return Leaf(a.tt, Env(a.w.parent, from_dict={
+    return Leaf(a.tt, Record(a.w.parent, from_dict={
         **a.w.e,
         **b.w.e,
     }))
@@ -884,6 +2259,69 @@ def safe_variable(a, b, env, cstack):
     return value, err, env, cstack
 
 
+def root_env(env):
+    while env.parent is not None:
+        env = env.parent
+    return env
+
+
+def builtin_table():
+    table = {}
+    for k, v in BUILTINS.items():
+        table[k] = v[0] if isinstance(v, list) else v
+    for mod, d in all_modules().items():
+        for k, v in as_module(d).items():
+            table[f"{mod}/{k}"] = v.w
+    return table
+
+
+_codec = None
+
+def get_codec():
+    global _codec
+    if _codec is None:
+        _codec = serial.Codec(Env, Function, Some, builtin_table())
+    return _codec
+
+
+def dump(a, b, env, cstack):
+    # Root env is rebuilt by prepare_env on the reading side, don't copy it
+    data = get_codec().dumps(a, root=root_env(env))
+    return Leaf("bytes", data), None, env, cstack
+
+
+def undump(a, b, env, cstack):
+    if a.tt != "bytes":
+        raise TypecheckError(f"undump: Expected bytes. Got '{a.tt}'")
+    x = get_codec().loads(a.w, root=root_env(env))
+    # Decoded envs get their bindings without Env.bind
+    override_all()
+    return x, None, env, cstack
+
+
+def save_bytes(a, b):
+    with open(b.w, "wb") as f:
+        f.write(a.w)
+    return a
+
+
+def load_bytes(a, b, env, cstack):
+    def read():
+        with open(a.w, "rb") as f:
+            return Leaf("bytes", f.read())
+
+    if not runnable(cstack) and (cstack.reactor is None or cstack.reactor.loop is None):
+        # Nothing else could run meanwhile
+        try:
+            return read(), None, env, cstack
+        except OSError as exc:
+            return Unit, Shift("error", Leaf(TT.ERROR, str(exc))), env, cstack
+    # Read in a thread, other tasks run meanwhile
+    reactor_of(cstack).submit(read, current_task(cstack))
+    x, env = park(env, cstack)
+    return x, None, env, cstack
+
+
 BUILTINS = {
     "jsoneach": lambda a, b: json_each(a.w, b),
     "=": eq,
@@ -902,11 +2340,12 @@ BUILTINS = {
     # "bake": bake,
     "open": lambda a, _: unwrap(a),
     "unwrap": lambda a, _: unwrap(a),
-    "emptyvec": lambda a, b: Leaf("vec", []),
-    ",": lambda a, b: Leaf("vec", [a, b]),
-    "tovec": lambda a, b: Leaf("vec", [a]),
+    "emptyvec": lambda a, b: mkvec([]),
+    "emptymap": lambda a, b: Leaf("map", hmap.EMPTY),
+    ",": lambda a, b: mkvec([a, b]),
+    "tovec": lambda a, b: mkvec([a]),
     "print": print_fn,
-    "wait": wait,
+    "wait": [wait],
     "O": new_object(Unit, Unit),
     "object": new_object(Unit, Unit),
     "bakevar": bakevar,
@@ -926,9 +2365,22 @@ BUILTINS = {
     "load":    [load],
     "import":  [import_],
     "tap":     [tap],
+    "gen":     [make_gen],
+    "yield":   [gen_yield],
+    "spawn":   [spawn],
+    "loop":    [loop_],
+    "while":   [while_],
+    "for":     [for_],
+    "break":   [break_],
+    "catch":   [catch],
+    "try":     [catch],
+    "raise":   [raise_],
+    "continue": [continue_],
+    "dump":    [dump],
+    "undump":  [undump],
     "IP":      lambda a, b: Tree(Unit, Leaf(TT.SYMBOL, "import"), Leaf(TT.STRING, "lib/prelude.hb")), # make it easy to import prelude
 
-    "showenv": [lambda a, b, env, cstack: (Leaf(TT.OBJECT, env), None, env, cstack)],
+    "showenv": [lambda a, b, env, cstack: (env.capture() or Leaf(TT.OBJECT, env), None, env, cstack)],
     "@":       [at],
     #"$":       [lambda a, b, env, cstack: (env.lookup(b.w, a), None, env, cstack)],
     "$":       [safe_variable],
@@ -960,53 +2412,95 @@ modules = {
         ("-", TT.NUM): lambda a, b: Leaf("range", (a.w[0] - b.w, a.w[1], a.w[2])),
         ("*", TT.NUM): lambda a, b: Leaf("range", (a.w[0] * b.w, a.w[1] * b.w, a.w[2])),
         # Division needs to convert to vec and then divide, otherwise lossy
-        "tovec": lambda a, b: Leaf("num_vec", list(range_to_range(a.w))),
+        "tovec": lambda a, b: charge(a.w[2]) or Leaf("num_vec", list(range_to_range(a.w))),
         # "fold": lambda a, b: Tree(Tree(a, Leaf(TT.SYMBOL, "tovec"), Unit), Leaf(TT.SYMBOL, "fold"), b),
         # "scan": lambda a, b: Tree(Tree(a, Leaf(TT.SYMBOL, "tovec"), Unit), Leaf(TT.SYMBOL, "scan"), b),
         #"sum": lambda a, b: Leaf(TT.NUM, arithmetic_series_sum(a.w[0], a.w[2], a.w[1])),
         "sum": lambda a, b: Leaf(TT.NUM, a.w[1] * a.w[2] * (a.w[2] - 1) // 2 + (a.w[2] * a.w[0])),
         "len": lambda a, b: Leaf(TT.NUM, a.w[2]),
         "each": lambda a, b: Tree(Tree(a, Leaf(TT.SYMBOL, "tovec"), Unit), Leaf(TT.SYMBOL, "each"), b),
+        "toseq": lambda a, b: Leaf("seq", Seq(Leaf(TT.NUM, x) for x in range_to_range(a.w))),
+    },
+    "seq": {
+        # Lazy, single pass sequence backed by python iterator, see seq.py
+        "each": [seq_each],
+        "filter": [seq_filter],
+        "fold": [fold],
+        ("take", TT.NUM): lambda a, b: Leaf("seq", Seq(itertools.islice(a.w, b.w))),
+        ("drop", TT.NUM): lambda a, b: Leaf("seq", Seq(itertools.islice(a.w, b.w, None))),
+        ("~", "seq"): lambda a, b: Leaf("seq", Seq(itertools.chain(a.w, b.w))),
+        "toseq": lambda a, b: a,
+        "tovec": lambda a, b: mkvec(metered(a.w)),
+        "len": lambda a, b: Leaf(TT.NUM, sum(1 for _ in metered(a.w))),
+        "drain": seq_drain,
     },
     "vec": {
-        ",": lambda a, b: a.w.append(b) or a,
-        "clone": lambda a, b: Leaf("vec", a.w[:]),
+        # Persistent - ',' returns new vec sharing structure with the old one
+        ",": lambda a, b: Leaf("vec", a.w.conj(b)),
+        "clone": lambda a, b: Leaf("vec", a.w),
         ("~", "vec"): lambda a, b: Leaf("vec", a.w + b.w),
+        ("@", TT.TREE): lambda a, b: Leaf("vec", a.w[b.L.w : b.R.w]),
+        ("set", TT.TREE): lambda a, b: Leaf("vec", a.w.set(b.L.w, b.R)),
         ("@", TT.NUM): lambda a, b: a.w[b.w],
         "len": lambda a, b: Leaf(TT.NUM, len(a.w)),
         "asmod": [asmod_vec],
         "each": [each],
+        "peach": [peach],
         "fold": [fold],
         ("zip", "vec"): zip_,
         ("@", "num_vec"): choose,
         "tonums": lambda a, b: Leaf("num_vec", [x.w for x in a.w]),
+        "toseq": lambda a, b: Leaf("seq", Seq(a.w)),
     },
     "num_vec": {
         ("~", "num_vec"): lambda a, b: Leaf("num_vec", a.w + b.w),
-        "clone": lambda a, b: Leaf("vec", a.w[:]),
-        "each": [lambda a, b, env, cstack: each(Leaf("num_vec", [Leaf(TT.NUM, x) for x in a.w]), b, env, cstack)],
+        "clone": lambda a, b: charge(len(a.w)) or mkvec(Leaf(TT.NUM, x) for x in a.w),
+        "each": [num_each],
+        "peach": [peach],
         "len": lambda a, b: Leaf(TT.NUM, len(a.w)),
-        ("+", "num_vec"): lambda a, b: Leaf("num_vec", [x + y for x, y in zip(a.w, b.w)]),
-        ("-", "num_vec"): lambda a, b: Leaf("num_vec", [x - y for x, y in zip(a.w, b.w)]),
-        ("*", "num_vec"): lambda a, b: Leaf("num_vec", [x * y for x, y in zip(a.w, b.w)]),
-        ("/", "num_vec"): lambda a, b: Leaf("num_vec", [x // y for x, y in zip(a.w, b.w)]),
+        ("+", "num_vec"): lambda a, b: charge(len(a.w)) or Leaf("num_vec", [x + y for x, y in zip(a.w, b.w)]),
+        ("-", "num_vec"): lambda a, b: charge(len(a.w)) or Leaf("num_vec", [x - y for x, y in zip(a.w, b.w)]),
+        ("*", "num_vec"): lambda a, b: charge(len(a.w)) or Leaf("num_vec", [x * y for x, y in zip(a.w, b.w)]),
+        ("/", "num_vec"): lambda a, b: charge(len(a.w)) or Leaf("num_vec", [x // y for x, y in zip(a.w, b.w)]),
         (",", TT.NUM): lambda a, b: a.w.append(b.w) or a,
-        ("=", TT.NUM): lambda a, b: Leaf("num_vec", [int(x == b.w) for x in a.w]),
-        ("+", TT.NUM): lambda a, b: Leaf("num_vec", [x + b.w for x in a.w]),
-        ("-", TT.NUM): lambda a, b: Leaf("num_vec", [x - b.w for x in a.w]),
-        ("*", TT.NUM): lambda a, b: Leaf("num_vec", [x * b.w for x in a.w]),
-        ("/", TT.NUM): lambda a, b: Leaf("num_vec", [x // b.w for x in a.w]),
+        ("=", TT.NUM): lambda a, b: charge(len(a.w)) or Leaf("num_vec", [int(x == b.w) for x in a.w]),
+        ("+", TT.NUM): lambda a, b: charge(len(a.w)) or Leaf("num_vec", [x + b.w for x in a.w]),
+        ("-", TT.NUM): lambda a, b: charge(len(a.w)) or Leaf("num_vec", [x - b.w for x in a.w]),
+        ("*", TT.NUM): lambda a, b: charge(len(a.w)) or Leaf("num_vec", [x * b.w for x in a.w]),
+        ("/", TT.NUM): lambda a, b: charge(len(a.w)) or Leaf("num_vec", [x // b.w for x in a.w]),
         ("@", TT.NUM): lambda a, b: Leaf(TT.NUM, a.w[b.w]),
         "toset": lambda a, b: Leaf("num_set", set(a.w)),
-        "max": lambda a, b: Leaf(TT.NUM, max(a.w)),
-        "min": lambda a, b: Leaf(TT.NUM, min(a.w)),
-        "sum": lambda a, b: Leaf(TT.NUM, sum(a.w)),
+        "max": lambda a, b: Leaf(TT.NUM, parallel.reduce(a.w, "max", max)),
+        "min": lambda a, b: Leaf(TT.NUM, parallel.reduce(a.w, "min", min)),
+        "sum": lambda a, b: Leaf(TT.NUM, parallel.reduce(a.w, "+", sum)),
         "foldby": num_fold_by,
         "fold": num_fold,
         "scan": scan,
         "order": order,
         ("@", "num_vec"): choose,
         ">>": lambda a, b: Tree(a, Leaf(TT.SYMBOL, "eachflat"), b),
+        "toseq": lambda a, b: Leaf("seq", Seq(Leaf(TT.NUM, x) for x in a.w)),
+    },
+    "task": {
+        "join": [join],
+    },
+    "chan": {
+        ".": make_chan,
+        "send": [chan_send],
+        "recv": [chan_recv],
+    },
+    "generator": {
+        "next": [lambda a, b, env, cstack: gen_send(a, Unit, env, cstack)],
+        "send": [gen_send],
+        "done": lambda a, b: Leaf(TT.NUM, int(a.w.done)),
+        "toseq": [gen_toseq],
+        "each": lambda a, b: Tree(Tree(a, Leaf(TT.SYMBOL, "toseq"), Unit), Leaf(TT.SYMBOL, "each"), b),
+        "fold": lambda a, b: Tree(Tree(a, Leaf(TT.SYMBOL, "toseq"), Unit), Leaf(TT.SYMBOL, "fold"), b),
+        "tovec": lambda a, b: Tree(Tree(a, Leaf(TT.SYMBOL, "toseq"), Unit), Leaf(TT.SYMBOL, "tovec"), b),
+    },
+    "bytes": {
+        "len": lambda a, b: Leaf(TT.NUM, len(a.w)),
+        ("save", TT.STRING): save_bytes,
     },
     "num_set": {
         ("~", "num_set"): lambda a, b: Leaf("num_set", a.w | b.w),
@@ -1047,7 +2541,7 @@ modules = {
     },
     TT.NUM: {
         "tovec": lambda a, b: Leaf("num_vec", [a.w]),
-        "rrep": lambda a, b: Leaf("vec", [b] * a.w),
+        "rrep": lambda a, b: charge(a.w) or mkvec([b] * a.w),
         # ("rep", TT.NUM): lambda a, b: Leaf("num_vec", [b.w] * a.w),
         (",", TT.NUM): lambda a, b: Leaf("num_vec", [a.w, b.w]),
         ("+", TT.NUM): lambda a, b: Leaf(TT.NUM, a.w + b.w),
@@ -1071,10 +2565,14 @@ modules = {
         ("*", TT.NUM): lambda a, b: Leaf(a.tt, a.w * b.w),
         ("~", TT.STRING): lambda a, b: Leaf(a.tt, a.w + b.w),
         ("~", TT.SYMBOL): lambda a, b: Leaf(a.tt, a.w + b.w),
-        ("/", TT.STRING): lambda a, b: Leaf("vec", [Leaf(TT.STRING, x) for x in a.w.split(b.w)]),
+        ("/", TT.STRING): lambda a, b: mkvec([Leaf(TT.STRING, x) for x in a.w.split(b.w)]),
         ("@", TT.NUM): lambda a, b: Leaf(TT.STRING, a.w[b.w]),
         ("@", TT.TREE): lambda a, b: Leaf(TT.STRING, a.w[b.L.w : b.R.w]),
         "len": lambda a, b: Leaf(TT.NUM, len(a.w)),
+        "loadbytes": [load_bytes],
+        "lines": lambda a, b: Leaf("seq", Seq(read_lines(a.w))),
+        "chunks": lambda a, b: Leaf("seq", Seq(read_chunks(a.w, "rt", chunk_size(b, 65536)))),
+        "readbytes": lambda a, b: Leaf("seq", Seq(read_chunks(a.w, "rb", chunk_size(b, 65536)))),
     },
     TT.FUNCTION: {
         # ("dispatch", TT.TREE): lambda a, b, env: set_dispatch(a, b, env), # TODO special
@@ -1110,11 +2608,150 @@ def as_module(mod_dict):
     return d
 
 
+# Heads that run code the optimizer can't see, which may rebind anything
+OPAQUE_HEADS = ("import", "load", "undump", "IP", "execute")
+
+
+def mentions(x, names):
+    """ Collect names x could bind or look up: every SYMBOL, STRING or
+    PUNCTUATION leaf except in head position, split on dispatch separator.
+    Returns False if x runs opaque code.
+    """
+    stack = [(x, False)]
+    while stack:
+        x, head = stack.pop()
+        if isinstance(x, Tree):
+            stack += [(x.L, False), (x.H, True), (x.R, False)]
+        elif x.tt in (TT.THUNK, TT.FUNTHUNK):
+            stack.append((x.w, False))
+        elif x.tt in (TT.SYMBOL, TT.STRING, TT.PUNCTUATION) \
+                and isinstance(x.w, str):
+            if head:
+                if x.w in OPAQUE_HEADS:
+                    return False
+            else:
+                names.add(x.w)
+                names.update(x.w.split(DISPATCH_SEP))
+    return True
+
+
+def module_names(env):
+    """ Function names defined in modules visible from env """
+    names = set()
+    while env is not None:
+        for v in env.e.values():
+            if isinstance(v, Leaf) and v.tt == TT.OBJECT:
+                names.update(str(k).split(DISPATCH_SEP)[0] for k in v.w.e)
+        env = env.parent
+    return names
+
+
+class StaticOp(Leaf):
+    """ Builtin a head symbol was resolved to by the optimizer """
+
+    def __init__(self, op, source):
+        super().__init__(op.tt, op.w, debug=source.debug)
+        self.source = source
+
+    def __repr__(self):
+        return repr(self.source)
+
+
+class Optimizer:
+    """ Constant folding and partial evaluation of parsed trees. Only
+    touches names the program can't rebind: ones it never mentions outside
+    of head position, still bound to their builtins in env.
+
+    Thunk and function bodies outlive this Execute, later ones may rebind
+    those names. Their heads are resolved, which Eval rechecks against
+    overridden, but they aren't folded.
+    """
+
+    def __init__(self, x, env):
+        self.env = env
+        mentioned = set()
+        self.closed = mentions(x, mentioned)
+        self.mentioned = mentioned
+        self.in_modules = module_names(env) if self.closed else set()
+        self.num_ops = self.closed and not num_ops_overrides \
+            and not mentioned & NUM_OP_NAMES
+
+    def static_op(self, name):
+        """ Builtin leaf name dispatches to whatever the operand types """
+        if not self.closed or name in self.mentioned or name in self.in_modules \
+                or name in overridden:
+            return None
+        op = self.env.lookup(name, None)
+        builtin = BUILTINS.get(name)
+        if op is None or builtin is None:
+            return None
+        fn = builtin[0] if isinstance(builtin, list) else builtin
+        return op if op.w is fn else None
+
+    def optimize(self, x, body=False):
+        if isinstance(x, Leaf):
+            if x.tt in (TT.THUNK, TT.FUNTHUNK):
+                optimized = self.optimize(x.w, True)
+                if optimized is not x.w:
+                    x = Leaf(x.tt, optimized, debug=x.debug)
+            return x
+
+        L, H, R = (self.optimize(y, body) for y in (x.L, x.H, x.R))
+        if isinstance(H, Leaf) and H.tt in (TT.PUNCTUATION, TT.SYMBOL) \
+                and isinstance(H.w, str):
+            folded = None if body else self.fold(L, H, R, x.debug)
+            if folded is not None:
+                return folded
+            op = self.static_op(H.w)
+            if op is not None:
+                H = StaticOp(op, H)
+        if L is x.L and H is x.H and R is x.R:
+            return x
+        return Tree(L, H, R, debug=x.debug)
+
+    def fold(self, L, H, R, debug):
+        fn = H.w
+        if self.num_ops and fn in NUM_OPS and is_int(L) and is_int(R) \
+                and (R.w != 0 or fn not in ("/", "mod")):
+            return Leaf(TT.NUM, int(NUM_OPS[fn](L.w, R.w)), debug=debug)
+        if fn == "til" and is_int(L) and is_int(R) and self.static_op(fn):
+            return Leaf("range", mkrange(L.w, 1, R.w), debug=debug)
+        if fn == "T" and is_literal(L) and is_literal(R) and self.static_op(fn):
+            return Leaf(TT.SYMBOL, L.tt, debug=debug)
+        # Branch known statically, evaluate it in place of then/if
+        if fn == "then" and is_int(L) and is_branches(R) and self.static_op(fn):
+            return unwrap(R.R if L.w == 0 else R.L)
+        if fn == "if" and is_branches(L) and is_literal(R) and self.static_op(fn):
+            return unwrap(L.L)
+        return None
+
+
+def is_int(x):
+    return isinstance(x, Leaf) and x.tt is TT.NUM and type(x.w) is int
+
+
+def is_literal(x):
+    # Symbols aren't literals, bakevars may turn them into variables
+    return isinstance(x, Leaf) and x.tt in (TT.NUM, TT.STRING, TT.UNIT)
+
+
+def is_branches(x):
+    """ Cons of branches whose evaluation has no effect """
+    return isinstance(x, Tree) and iscons(x.H) and all(
+        is_literal(y) or (isinstance(y, Leaf) and y.tt in (TT.THUNK, TT.FUNTHUNK))
+        for y in (x.L, x.R))
+
+
+def optimize(x, env):
+    return Optimizer(x, env).optimize(x)
+
+
 def Execute_(code, env, cstack):
     x = code
     x = Lex(x)
     # print("LEX", y)
     x = Parse(x)
+    x = optimize(x, env)
 
     # Wrap in error reset
     x = Tree(Leaf(TT.SYMBOL, "error", debug=Unit.debug),
@@ -1129,16 +2766,29 @@ def Execute_(code, env, cstack):
     return x, err, env, cstack
 
 
-def Execute(code, env, cstack):
+def Execute(code, env, cstack, resume=False, budget=None):
+    """ Run code within budget, if given. Resumed run keeps its budget """
+    global active_budget
+    outer = active_budget
+    if not resume:
+        cstack.budget = budget
+        if all(st.empty() for st in cstack.rope) and fresh_env(env):
+            recheck_overrides(env)
+    active_budget = cstack.budget
     try:
+        if resume:
+            # Go on after Idle, with whichever task is ready
+            x, env = run_next(cstack)
+            return Eval(x, env, cstack, resume=True)
         return Execute_(code, env, cstack)
     except (ParseError, NoDispatch, CantReduce) as err:
         #print("ERR", err, type(err), file=sys.stderr)
 
-        if err.witness.debug is not None:
-            start = err.witness.debug.start
-            end = err.witness.debug.end
-            lineno = err.witness.debug.lineno
+        span = error_span(err, cstack)
+        if span is not None:
+            start = span.start
+            end = span.end
+            lineno = span.lineno
             line = code.split("\n")[lineno]
 
             break_ = "  "
@@ -1154,13 +2804,36 @@ def Execute(code, env, cstack):
         #print(f"Parse error: {err}", file=sys.stderr)
     except UnexpectedType as err:
         print("UNEXPECTED TYPE", err, file=sys.stderr)
+    except Raised as err:
+        print(f"Unhandled raise: {err.value}", file=sys.stderr)
     except Cactus.Empty as err:
         print(f"No matching reset with tag {err.tag}", file=sys.stderr)
         cstack.spush(ROOT_TAG)
+    finally:
+        active_budget = outer
 
     return Unit, None, None, None
 
 
+async def ExecuteAsync(code, env, cstack, budget=None):
+    """ Execute under the running asyncio loop. Whenever all of its tasks
+    wait on timers or reads, or its budget's time slice is used up, the
+    loop is free to run other programs.
+    """
+    import asyncio
+    reactor_of(cstack).loop = asyncio.get_running_loop()
+    resume = False
+    while True:
+        try:
+            return Execute(code, env, cstack, resume, budget)
+        except Idle:
+            await cstack.reactor.idle(cstack)
+            resume = True
+        except Suspended:
+            await asyncio.sleep(0)
+            resume = True
+
+
 def mod_merge(a, b):
     m = {k: v for k, v in a.items()}
     for k, v in b.items():
@@ -1174,10 +2847,84 @@ def mod_merge(a, b):
     return m
 
 
+def all_modules():
+    mods = modules
+    for ext in (matrix.modules, rope.modules, strvec.modules, hmap.modules):
+        mods = mod_merge(mods, ext)
+    return mods
+
+
+# Builtins the optimizer resolves heads to
+STATIC_NAMES = frozenset(k for k in BUILTINS if isinstance(k, str))
+GUARDED_NAMES = NUM_OP_NAMES | STATIC_NAMES
+record.guarded_names = GUARDED_NAMES
+record.on_guarded = override
+# name or (module, name) -> builtin function, see recheck_overrides
+builtin_fns = None
+
+
+def is_builtin(key, x):
+    global builtin_fns
+    if builtin_fns is None:
+        builtin_fns = {k: v.w for k, v in as_module(BUILTINS).items()}
+        for mod_key, mod in all_modules().items():
+            builtin_fns.update(((mod_key, k), v.w) for k, v in as_module(mod).items())
+    return isinstance(x, Leaf) and builtin_fns.get(key) is x.w
+
+
+def overrides_in(env):
+    """ Guarded names env and its parents bind to something else """
+    if env is None:
+        return set()
+    shared = getattr(env, "shared", False)
+    if shared and env.overrides is not None:
+        # Can't change, scanned once
+        return set(env.overrides)
+    found = overrides_in(env.parent)
+    for name, value in env.e.items():
+        if isinstance(value, Leaf) and value.tt == TT.OBJECT:
+            # Module, whatever it's bound as its functions are checked
+            found.update(k for k, v in value.w.e.items()
+                         if k in GUARDED_NAMES and not is_builtin((name, k), v))
+        elif name in GUARDED_NAMES and not is_builtin(name, value):
+            found.add(name)
+    if shared:
+        env.overrides = frozenset(found)
+    return found
+
+
+def fresh_env(env):
+    """ env has no bindings of its own and only shared parents, like a
+    request of hb.py serve gets. Nothing an earlier program made, eg. a
+    closure holding an overriding env, can be reached from it.
+    """
+    if type(env) is not Env or env.e:
+        return False
+    env = env.parent
+    while env is not None:
+        if not getattr(env, "shared", False):
+            return False
+        env = env.parent
+    return True
+
+
+def recheck_overrides(env):
+    """ Forget overrides the shared parents of fresh env don't make. Only
+    valid before a program runs on an idle stack, anywhere else overrides
+    may be held by closures and stay.
+    """
+    global num_ops_overrides
+    if not overridden:
+        return
+    found = overrides_in(env)
+    overridden.clear()
+    overridden.update(found)
+    num_ops_overrides = int(bool(found & NUM_OP_NAMES))
+
+
 def prepare_env():
-    modules_ = mod_merge(modules, matrix.modules)
     mods = {k: Leaf(TT.OBJECT, Env(None, from_dict=as_module(mod)))
-            for k, mod in modules_.items()}
+            for k, mod in all_modules().items()}
 
     rootenv = Env(None, from_dict={
         **as_module(BUILTINS),
@@ -1206,6 +2953,12 @@ def Repl(env, rstack, prompt="> "):
 
 
 if __name__ == "__main__":
+    if "-j" in sys.argv:
+        # Worker processes of peach and parallel reductions
+        i = sys.argv.index("-j")
+        JOBS = parallel.JOBS = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
     env = prepare_env()
     cstack = Cactus(ROOT_TAG)
 
@@ -1225,6 +2978,21 @@ if __name__ == "__main__":
 
             x, _, env, cstack = Execute(src, env, cstack)
             print(x)
+        elif cmd == "opt":
+            # Show parsed tree before and after optimizer pass
+            if len(sys.argv) >= 3:
+                with open(sys.argv[2]) as f:
+                    src = f.read()
+            else:
+                src = sys.stdin.read()
+
+            x = Parse(Lex(src))
+            print("before:", x)
+            print("after: ", optimize(x, env))
+        elif cmd == "serve":
+            # Warm interpreters on a Unix socket, see server.py
+            import server
+            server.main(sys.argv[2:], JOBS)
         else:
-            print("Missing command (run)", file=sys.stderr)
+            print("Missing command (run | opt | serve)", file=sys.stderr)
             sys.exit(1)
@@ -0,0 +1,298 @@
+""" Persistent hash map (HAMT) keyed by structural value of hb values. """
+
+from c import Leaf, Tree, TT, Unit
+from pvec import PVec, EMPTY as EMPTY_VEC
+
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_MASK = (1 << 64) - 1
+
+
+def hb_hash(x):
+    if isinstance(x, Tree):
+        return hash((TT.TREE, hb_hash(x.L), hb_hash(x.H), hb_hash(x.R)))
+    tt, w = str(x.tt), x.w
+    if tt == "vec":
+        return hash((tt, tuple(hb_hash(y) for y in w)))
+    if tt == "num_vec":
+        return hash((tt, tuple(w)))
+    try:
+        return hash((tt, w))
+    except TypeError:
+        return hash((tt, id(w)))
+
+
+def hb_eq(a, b):
+    if isinstance(a, Tree) or isinstance(b, Tree):
+        return isinstance(a, Tree) and isinstance(b, Tree) \
+            and hb_eq(a.L, b.L) and hb_eq(a.H, b.H) and hb_eq(a.R, b.R)
+    if str(a.tt) != str(b.tt):
+        return False
+    if a.w is b.w:
+        return True
+    if str(a.tt) == "vec":
+        return len(a.w) == len(b.w) and all(hb_eq(x, y) for x, y in zip(a.w, b.w))
+    return a.w == b.w
+
+
+def popcount(x):
+    return bin(x).count("1")
+
+
+class Node:
+
+    __slots__ = ("bitmap", "items")
+
+    def __init__(self, bitmap, items):
+        self.bitmap = bitmap
+        # Each item is either (hash, key, value) or a sub Node/Collision
+        self.items = items
+
+
+class Collision:
+
+    __slots__ = ("h", "items")
+
+    def __init__(self, h, items):
+        self.h = h
+        self.items = items
+
+
+EMPTY_NODE = Node(0, ())
+
+
+def item_hash(item):
+    return item[0] if isinstance(item, tuple) else item.h
+
+
+def merge(shift, a, b):
+    """ Node holding two items with distinct keys """
+    ha, hb = item_hash(a), item_hash(b)
+    if ha == hb:
+        xs = a.items if isinstance(a, Collision) else (a,)
+        return Collision(ha, xs + (b,))
+    ia, ib = (ha >> shift) & MASK, (hb >> shift) & MASK
+    if ia == ib:
+        return Node(1 << ia, (merge(shift + BITS, a, b),))
+    items = (a, b) if ia < ib else (b, a)
+    return Node((1 << ia) | (1 << ib), items)
+
+
+def get(node, h, key):
+    shift = 0
+    while True:
+        if isinstance(node, Collision):
+            for eh, k, v in node.items:
+                if hb_eq(k, key):
+                    return v
+            return None
+        bit = 1 << ((h >> shift) & MASK)
+        if not node.bitmap & bit:
+            return None
+        item = node.items[popcount(node.bitmap & (bit - 1))]
+        if isinstance(item, tuple):
+            if item[0] == h and hb_eq(item[1], key):
+                return item[2]
+            return None
+        node = item
+        shift += BITS
+
+
+def assoc(node, shift, h, key, value):
+    if isinstance(node, Collision):
+        if node.h != h:
+            return merge(shift, node, (h, key, value))
+        items = tuple(e for e in node.items if not hb_eq(e[1], key))
+        return Collision(h, items + ((h, key, value),))
+
+    bit = 1 << ((h >> shift) & MASK)
+    idx = popcount(node.bitmap & (bit - 1))
+    items = node.items
+    if not node.bitmap & bit:
+        return Node(node.bitmap | bit, items[:idx] + ((h, key, value),) + items[idx:])
+
+    item = items[idx]
+    if isinstance(item, tuple):
+        if item[0] == h and hb_eq(item[1], key):
+            new = (h, key, value)
+        else:
+            new = merge(shift + BITS, item, (h, key, value))
+    else:
+        new = assoc(item, shift + BITS, h, key, value)
+    return Node(node.bitmap, items[:idx] + (new,) + items[idx + 1:])
+
+
+def dissoc(node, shift, h, key):
+    """ Returns node without key, None if it would be empty """
+    if isinstance(node, Collision):
+        items = tuple(e for e in node.items if not hb_eq(e[1], key))
+        if len(items) == 1:
+            return items[0]
+        return Collision(node.h, items)
+
+    bit = 1 << ((h >> shift) & MASK)
+    idx = popcount(node.bitmap & (bit - 1))
+    items = node.items
+    item = items[idx]
+    if isinstance(item, tuple):
+        new = None
+    else:
+        new = dissoc(item, shift + BITS, h, key)
+        # Pull single remaining entry up
+        if isinstance(new, Node) and len(new.items) == 1 \
+                and isinstance(new.items[0], tuple):
+            new = new.items[0]
+
+    if new is None:
+        if len(items) == 1:
+            return None
+        return Node(node.bitmap & ~bit, items[:idx] + items[idx + 1:])
+    return Node(node.bitmap, items[:idx] + (new,) + items[idx + 1:])
+
+
+# Marks deleted slot in insertion order
+TOMB = object()
+
+
+class HMap:
+    """ Persistent map. HAMT maps key to (position, value), `order` keeps
+    keys by insertion position so iteration follows insertion order.
+    """
+
+    __slots__ = ("root", "count", "order")
+
+    def __init__(self, root, count, order):
+        self.root = root
+        self.count = count
+        self.order = order
+
+    @staticmethod
+    def from_pairs(pairs):
+        m = EMPTY
+        for k, v in pairs:
+            m = m.assoc(k, v)
+        return m
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, key):
+        entry = get(self.root, hb_hash(key) & HASH_MASK, key)
+        return None if entry is None else entry[1]
+
+    def has(self, key):
+        return get(self.root, hb_hash(key) & HASH_MASK, key) is not None
+
+    def assoc(self, key, value):
+        h = hb_hash(key) & HASH_MASK
+        entry = get(self.root, h, key)
+        if entry is not None:
+            root = assoc(self.root, 0, h, key, (entry[0], value))
+            return HMap(root, self.count, self.order)
+        pos = len(self.order)
+        root = assoc(self.root, 0, h, key, (pos, value))
+        return HMap(root, self.count + 1, self.order.conj(key))
+
+    def dissoc(self, key):
+        h = hb_hash(key) & HASH_MASK
+        entry = get(self.root, h, key)
+        if entry is None:
+            return self
+        root = dissoc(self.root, 0, h, key) or EMPTY_NODE
+        m = HMap(root, self.count - 1, self.order.set(entry[0], TOMB))
+        # Rebuild once order is mostly tombstones, amortized O(1) per delete
+        if len(m.order) > 32 and m.count < len(m.order) // 2:
+            m = HMap.from_pairs(m.items())
+        return m
+
+    def keys(self):
+        return (k for k in self.order if k is not TOMB)
+
+    def items(self):
+        return ((k, self.lookup(k)) for k in self.keys())
+
+    def merge(self, other):
+        m = self
+        for k, v in other.items():
+            m = m.assoc(k, v)
+        return m
+
+    def __str__(self):
+        return "{" + ", ".join(f"{k}: {v}" for k, v in self.items()) + "}"
+
+    def __repr__(self):
+        return str(self)
+
+
+EMPTY = HMap(EMPTY_NODE, 0, EMPTY_VEC)
+
+
+def items_of(x):
+    """ Iterate hb collection as hb values """
+    if x.tt in ("num_vec", "num_set"):
+        return (Leaf(TT.NUM, y) for y in x.w)
+    if x.tt == "str_vec":
+        return (Leaf(TT.STRING, y) for y in x.w.strs())
+    return iter(x.w)
+
+
+def tomap(a, b):
+    return Leaf("map", HMap.from_pairs(zip(items_of(a), items_of(b))))
+
+
+def counts(a, b):
+    m = EMPTY
+    for x in items_of(a):
+        n = m.lookup(x)
+        m = m.assoc(x, Leaf(TT.NUM, 1 if n is None else n.w + 1))
+    return Leaf("map", m)
+
+
+def unique(a, b):
+    seen = EMPTY
+    out = []
+    for x in items_of(a):
+        if not seen.has(x):
+            seen = seen.assoc(x, Unit)
+            out.append(x)
+    return Leaf("vec", PVec.from_list(out))
+
+
+def lookup(a, b):
+    value = a.w.lookup(b)
+    return Unit if value is None else value
+
+
+def pair(k, v):
+    return Tree(k, Leaf(TT.PUNCTUATION, ":"), v)
+
+
+modules = {
+    "map": {
+        "@": lookup,
+        ("set", TT.TREE): lambda a, b: Leaf("map", a.w.assoc(b.L, b.R)),
+        "del": lambda a, b: Leaf("map", a.w.dissoc(b)),
+        "has": lambda a, b: Leaf(TT.NUM, int(a.w.has(b))),
+        "len": lambda a, b: Leaf(TT.NUM, len(a.w)),
+        "keys": lambda a, b: Leaf("vec", PVec.from_list(a.w.keys())),
+        "values": lambda a, b: Leaf("vec", PVec.from_list(v for _, v in a.w.items())),
+        "tovec": lambda a, b: Leaf("vec", PVec.from_list(pair(k, v) for k, v in a.w.items())),
+        ("~", "map"): lambda a, b: Leaf("map", a.w.merge(b.w)),
+        "each": lambda a, b: Tree(Tree(a, Leaf(TT.SYMBOL, "tovec"), Unit), Leaf(TT.SYMBOL, "each"), b),
+        "fold": lambda a, b: Tree(Tree(a, Leaf(TT.SYMBOL, "tovec"), Unit), Leaf(TT.SYMBOL, "fold"), b),
+    },
+    "vec": {
+        "tomap": tomap,
+        "counts": counts,
+        "unique": unique,
+    },
+    "num_vec": {
+        "tomap": tomap,
+        "counts": counts,
+    },
+    "str_vec": {
+        "tomap": tomap,
+        "counts": counts,
+    },
+}
@@ -1,4 +1,8 @@
+import functools
+import operator
+
 from c import Tree, Leaf, TT
+import parallel
 
 
 class Matrix:
@@ -44,6 +48,22 @@ def tomatrix(vec):
     return Matrix([len(vec.w)], vec.w)
 
 
+FOLD_OPS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.floordiv,
+}
+
+
+def fold(a, b):
+    op = b.w
+    x = parallel.par_reduce(a.w._ar, op) if op in parallel.COMBINE else None
+    if x is None:
+        x = functools.reduce(FOLD_OPS[op], a.w._ar)
+    return Leaf(TT.NUM, x)
+
+
 modules = {
     "num_vec": {
         "tomatrix": lambda a, b: Leaf("matrix", tomatrix(a)),
@@ -56,5 +76,9 @@ modules = {
         ("/", TT.NUM): lambda a, b: Leaf(a.tt, a.w.apply((lambda a, b: a // b), b.w)),
         "shape": lambda a, b: Leaf("num_vec", a.w.shape()),
         "rank": lambda a, b: Leaf(TT.NUM, a.w.rank()),
+        "sum": lambda a, b: Leaf(TT.NUM, parallel.reduce(a.w._ar, "+", sum)),
+        "max": lambda a, b: Leaf(TT.NUM, parallel.reduce(a.w._ar, "max", max)),
+        "min": lambda a, b: Leaf(TT.NUM, parallel.reduce(a.w._ar, "min", min)),
+        "fold": fold,
     }
 }
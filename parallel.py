@@ -0,0 +1,184 @@
+""" Parallel reductions of big num_vec and matrix data.
+
+Numbers are copied once into a shared memory block of int64s and worker
+processes reduce slices of it in place: only slice bounds go out, only
+partial results come back. Partials are combined with the same
+associative operator. Anything that doesn't fit int64, or is too small
+to pay for the copy, is left to the serial code.
+
+Workers are opt-in with hb.py -j: copying a list into int64s alone takes
+longer than a serial sum or max of it, only foldby's per item loop can
+make up for the copy, given a few cores.
+"""
+
+from array import array
+import atexit
+import math
+import operator
+import os
+
+
+# Worker processes, None reduces serially. hb.py -j sets it
+JOBS = None
+# Shorter inputs are reduced serially
+PAR_MIN = 1_000_000
+
+# Associative reductions of a slice, also used to combine partials
+REDUCE = {
+    "+": sum,
+    "*": math.prod,
+    "max": max,
+    "min": min,
+}
+# Associative ops of foldby
+COMBINE = {
+    "+": operator.add,
+    "*": operator.mul,
+}
+
+
+def jobs():
+    return JOBS or 1
+
+
+# (pool, its size, pid of the process that started it)
+worker_pool = None
+
+
+def pool(size):
+    """ Pool of size worker processes, started on first use and kept for
+    later calls. A forked child starts its own.
+    """
+    global worker_pool
+    if worker_pool is not None:
+        p, n, pid = worker_pool
+        if pid != os.getpid():
+            worker_pool = None
+        elif n == size:
+            return p
+        else:
+            close_pool()
+    import multiprocessing
+    worker_pool = (multiprocessing.Pool(size), size, os.getpid())
+    return worker_pool[0]
+
+
+def close_pool():
+    global worker_pool
+    if worker_pool is not None and worker_pool[2] == os.getpid():
+        worker_pool[0].terminate()
+    worker_pool = None
+
+
+atexit.register(close_pool)
+
+
+def to_shared(xs):
+    """ SharedMemory holding xs as int64s, None if some don't fit """
+    from multiprocessing import shared_memory
+    try:
+        arr = array("q", xs)
+    except (TypeError, OverflowError):
+        return None
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(arr) * arr.itemsize))
+    with memoryview(arr).cast("B") as raw:
+        shm.buf[:len(raw)] = raw
+    return shm
+
+
+def slices(n, parts):
+    size = -(-n // parts)
+    return [(lo, min(lo + size, n)) for lo in range(0, n, size)]
+
+
+def reduce_slice(task):
+    """ Worker: reduction of one slice of a shared block """
+    from multiprocessing import shared_memory
+    name, lo, hi, op = task
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        with shm.buf.cast("q") as view, view[lo:hi] as part:
+            return REDUCE[op](part)
+    finally:
+        shm.close()
+
+
+def fold_by_slice(task):
+    """ Worker: per-key accumulators of one slice, None for unseen keys """
+    from multiprocessing import shared_memory
+    name, key_name, lo, hi, op, slots = task
+    op = COMBINE[op]
+    shm, key_shm = shared_memory.SharedMemory(name=name), \
+        shared_memory.SharedMemory(name=key_name)
+    try:
+        with shm.buf.cast("q") as view, key_shm.buf.cast("q") as keys:
+            acc = [None] * slots
+            for i in range(lo, hi):
+                slot = keys[i]
+                value = acc[slot]
+                acc[slot] = view[i] if value is None else op(value, view[i])
+            return acc
+    finally:
+        shm.close()
+        key_shm.close()
+
+
+def run(fn, tasks):
+    return pool(jobs()).map(fn, tasks)
+
+
+def par_reduce(xs, op):
+    """ REDUCE[op] of xs by worker processes, None to reduce serially """
+    n = jobs()
+    if op not in REDUCE or n <= 1 or len(xs) < PAR_MIN:
+        return None
+    shm = to_shared(xs)
+    if shm is None:
+        return None
+    try:
+        parts = run(reduce_slice, [(shm.name, lo, hi, op)
+                                   for lo, hi in slices(len(xs), n)])
+    finally:
+        shm.close()
+        shm.unlink()
+    return REDUCE[op](parts)
+
+
+def par_fold_by(xs, keys, op):
+    """ Per-key fold of xs with op by worker processes, None to fold
+    serially.
+    """
+    n = jobs()
+    if op not in COMBINE or n <= 1 or len(xs) < PAR_MIN:
+        return None
+    length = min(len(xs), len(keys))
+    if not length or min(keys) < 0:
+        return None
+    shm = to_shared(xs)
+    if shm is None:
+        return None
+    key_shm = to_shared(keys)
+    try:
+        if key_shm is None:
+            return None
+        slots = max(keys) + 1
+        parts = run(fold_by_slice, [(shm.name, key_shm.name, lo, hi, op, slots)
+                                    for lo, hi in slices(length, n)])
+    finally:
+        for s in (shm, key_shm):
+            if s is not None:
+                s.close()
+                s.unlink()
+
+    combine = COMBINE[op]
+    acc = parts[0]
+    for part in parts[1:]:
+        acc = [y if x is None else x if y is None else combine(x, y)
+               for x, y in zip(acc, part)]
+    return acc
+
+
+def reduce(xs, op, serial):
+    """ REDUCE[op] of xs, in parallel when it's big enough """
+    x = par_reduce(xs, op)
+    return serial(xs) if x is None else x
@@ -0,0 +1,154 @@
+""" Persistent vector backing hb's `vec`.
+
+Elements live in tuples of up to CHUNK items at the leaves of a depth
+balanced binary tree whose inner nodes carry subtree sizes. Append, update,
+concat and slice copy only one root-to-leaf path (plus at most one chunk)
+and share everything else, so none of them copies the whole vector.
+"""
+
+from avl import concat
+
+
+CHUNK = 32
+
+
+class PVec:
+
+    __slots__ = ("left", "right", "chunk", "length", "depth")
+    CHUNK = CHUNK
+
+    def __init__(self, left=None, right=None, chunk=()):
+        self.left = left
+        self.right = right
+        self.chunk = chunk
+        if left is None:
+            self.length = len(chunk)
+            self.depth = 0
+        else:
+            self.length = left.length + right.length
+            self.depth = max(left.depth, right.depth) + 1
+
+    @staticmethod
+    def from_list(xs):
+        xs = tuple(xs)
+        if len(xs) <= CHUNK:
+            return PVec(chunk=xs)
+        level = [PVec(chunk=xs[i : i + CHUNK]) for i in range(0, len(xs), CHUNK)]
+        while len(level) > 1:
+            level = [PVec(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                     for i in range(0, len(level), 2)]
+        return level[0]
+
+    def is_leaf(self):
+        return self.left is None
+
+    def __len__(self):
+        return self.length
+
+    def chunks(self):
+        stack = [self]
+        while stack:
+            v = stack.pop()
+            if v.is_leaf():
+                yield v.chunk
+            else:
+                stack.append(v.right)
+                stack.append(v.left)
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
+
+    def index(self, i):
+        v = self
+        while not v.is_leaf():
+            if i < v.left.length:
+                v = v.left
+            else:
+                i -= v.left.length
+                v = v.right
+        return v.chunk[i]
+
+    def leaf(self, i):
+        """ (chunk, index of its first item) of the leaf holding item i """
+        v, start = self, 0
+        while not v.is_leaf():
+            if i < v.left.length:
+                v = v.left
+            else:
+                i -= v.left.length
+                start += v.left.length
+                v = v.right
+        return v.chunk, start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            if step != 1:
+                return PVec.from_list(list(self)[i])
+            return self.slice(start, stop)
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("vec index out of range")
+        return self.index(i)
+
+    def slice(self, start, stop):
+        if start >= stop:
+            return EMPTY
+        if start == 0 and stop == self.length:
+            return self
+        if self.is_leaf():
+            return PVec(chunk=self.chunk[start:stop])
+        n = self.left.length
+        if stop <= n:
+            return self.left.slice(start, stop)
+        if start >= n:
+            return self.right.slice(start - n, stop - n)
+        return concat(self.left.slice(start, n), self.right.slice(0, stop - n))
+
+    def conj(self, x):
+        """ New vector with x appended """
+        return concat(self, PVec(chunk=(x,)))
+
+    def set(self, i, x):
+        """ New vector with item i replaced """
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("vec index out of range")
+        return self._set(i, x)
+
+    def _set(self, i, x):
+        if self.is_leaf():
+            return PVec(chunk=self.chunk[:i] + (x,) + self.chunk[i + 1:])
+        n = self.left.length
+        if i < n:
+            return PVec(self.left._set(i, x), self.right)
+        return PVec(self.left, self.right._set(i - n, x))
+
+    def __add__(self, other):
+        if not isinstance(other, PVec):
+            other = PVec.from_list(other)
+        return concat(self, other)
+
+    def __radd__(self, other):
+        return concat(PVec.from_list(other), self)
+
+    def __eq__(self, other):
+        if isinstance(other, (PVec, list, tuple)):
+            return len(self) == len(other) and all(
+                x is y or x == y for x, y in zip(self, other))
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __str__(self):
+        return str(list(self))
+
+    def __repr__(self):
+        return str(self)
+
+
+EMPTY = PVec()
@@ -0,0 +1,129 @@
+""" Records with shared, interned field layouts ("shapes", hidden classes).
+
+Objects built with the same keys in the same order share one Shape, so the
+key table is stored once no matter how many records use it. Values live in
+a per-record slot list. Adding a field follows a cached transition to the
+next shape. Transitions are held weakly, a shape lives while some record
+or a shape after it uses it.
+
+A record with more than MAX_SHAPE_KEYS fields keeps a plain dict instead
+(dictionary mode), which bounds the chain of shapes a record built field
+by field goes through and the cost of each one.
+"""
+
+import weakref
+
+
+# Records with more fields are in dictionary mode
+MAX_SHAPE_KEYS = 64
+
+
+class Shape:
+
+    __slots__ = ("keys", "index", "parent", "transitions", "__weakref__")
+
+    def __init__(self, keys, parent=None):
+        self.keys = keys
+        self.index = {k: i for i, k in enumerate(keys)}
+        # Keeps the way to this shape cached while it's used
+        self.parent = parent
+        self.transitions = weakref.WeakValueDictionary()
+
+    def add(self, key):
+        """ Shape with key added, None for dictionary mode """
+        if len(self.keys) >= MAX_SHAPE_KEYS:
+            return None
+        shape = self.transitions.get(key)
+        if shape is None:
+            shape = self.transitions[key] = Shape(self.keys + (key,), self)
+        return shape
+
+    @staticmethod
+    def of(keys):
+        """ Shape of keys, None for dictionary mode """
+        keys = tuple(keys)
+        if len(keys) > MAX_SHAPE_KEYS:
+            return None
+        shape = ROOT_SHAPE
+        for k in keys:
+            shape = shape.add(k)
+        return shape
+
+
+ROOT_SHAPE = Shape(())
+# Names whose binding the interpreter watches, and what it does then
+guarded_names = frozenset()
+
+
+def on_guarded(name):
+    pass
+
+
+class Record:
+    """ Drop-in for Env where the set of names is known up front """
+
+    __slots__ = ("shape", "slots", "parent")
+
+    def __init__(self, parent, from_dict=None):
+        from_dict = from_dict or {}
+        self.set_fields(from_dict.keys(), from_dict.values())
+        self.parent = parent
+
+    def set_fields(self, keys, values):
+        self.shape = Shape.of(keys)
+        if self.shape is None:
+            self.slots = dict(zip(keys, values))
+        else:
+            self.slots = list(values)
+
+    @property
+    def e(self):
+        if self.shape is None:
+            return dict(self.slots)
+        return dict(zip(self.shape.keys, self.slots))
+
+    def lookup(self, name, or_else):
+        if self.shape is None:
+            if name in self.slots:
+                return self.slots[name]
+        else:
+            i = self.shape.index.get(name)
+            if i is not None:
+                return self.slots[i]
+        if self.parent:
+            return self.parent.lookup(name, or_else)
+        return or_else
+
+    def find_env(self, name):
+        if name in (self.slots if self.shape is None else self.shape.index):
+            return self
+        if self.parent:
+            return self.parent.find_env(name)
+        return None
+
+    def bind(self, name, value):
+        if name in guarded_names:
+            on_guarded(name)
+        if self.shape is None:
+            self.slots[name] = value
+            return value
+        i = self.shape.index.get(name)
+        if i is not None:
+            self.slots[i] = value
+            return value
+        shape = self.shape.add(name)
+        if shape is None:
+            self.slots = dict(zip(self.shape.keys, self.slots))
+            self.slots[name] = value
+        else:
+            self.slots.append(value)
+        self.shape = shape
+        return value
+
+    def assign(self, name, value):
+        env = self.find_env(name) or self
+        env.bind(name, value)
+        return value
+
+    def __repr__(self):
+        return repr(self.e)
@@ -0,0 +1,177 @@
+from avl import concat
+from c import Leaf, TT
+from seq import Seq
+
+
+# Leaves shorter than this get merged on concatenation
+CHUNK = 256
+
+
+class Rope:
+    """ Immutable balanced (AVL by depth) rope of python strings.
+
+    Concatenation and slicing share subtrees, flat string is built on demand.
+    """
+
+    __slots__ = ("left", "right", "chunk", "length", "depth", "_flat")
+    CHUNK = CHUNK
+
+    def __init__(self, left=None, right=None, chunk=""):
+        self.left = left
+        self.right = right
+        self.chunk = chunk
+        self._flat = None
+        if left is None:
+            self.length = len(chunk)
+            self.depth = 0
+        else:
+            self.length = left.length + right.length
+            self.depth = max(left.depth, right.depth) + 1
+
+    @staticmethod
+    def from_str(s):
+        if len(s) <= CHUNK:
+            return Rope(chunk=s)
+        # Build balanced tree bottom up
+        level = [Rope(chunk=s[i : i + CHUNK]) for i in range(0, len(s), CHUNK)]
+        while len(level) > 1:
+            level = [Rope(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                     for i in range(0, len(level), 2)]
+        return level[0]
+
+    def is_leaf(self):
+        return self.left is None
+
+    def __len__(self):
+        return self.length
+
+    def __add__(self, other):
+        if isinstance(other, str):
+            other = Rope(chunk=other)
+        return concat(self, other)
+
+    def __radd__(self, other):
+        return concat(Rope(chunk=other), self)
+
+    def chunks(self):
+        stack = [self]
+        while stack:
+            r = stack.pop()
+            if r.is_leaf():
+                if r.chunk:
+                    yield r.chunk
+            else:
+                stack.append(r.right)
+                stack.append(r.left)
+
+    def __str__(self):
+        if self._flat is None:
+            self._flat = self.chunk if self.is_leaf() else "".join(self.chunks())
+        return self._flat
+
+    def __repr__(self):
+        return str(self)
+
+    def __eq__(self, other):
+        if isinstance(other, (Rope, str)):
+            return len(self) == len(other) and str(self) == str(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def index(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("rope index out of range")
+        r = self
+        while not r.is_leaf():
+            if i < r.left.length:
+                r = r.left
+            else:
+                i -= r.left.length
+                r = r.right
+        return r.chunk[i]
+
+    def slice(self, start, stop):
+        start, stop, _ = slice(start, stop).indices(self.length)
+        if start >= stop:
+            return Rope()
+        return self._slice(start, stop)
+
+    def _slice(self, start, stop):
+        if start == 0 and stop == self.length:
+            return self
+        if self.is_leaf():
+            return Rope(chunk=self.chunk[start:stop])
+        n = self.left.length
+        if stop <= n:
+            return self.left._slice(start, stop)
+        if start >= n:
+            return self.right._slice(start - n, stop - n)
+        return concat(self.left._slice(start, n), self.right._slice(0, stop - n))
+
+    def split(self, sep):
+        """ Lazily split, separators may span chunk boundaries. Each chunk
+        is searched once, together with the end of the part before it that
+        a separator could start in.
+        """
+        if not sep:
+            raise ValueError("empty separator")
+        keep = len(sep) - 1
+        # Part so far, but its last keep chars are still in tail
+        pieces, tail = [], ""
+        for chunk in self.chunks():
+            window = tail + chunk
+            start = 0
+            while True:
+                i = window.find(sep, start)
+                if i < 0:
+                    break
+                pieces.append(window[start:i])
+                yield "".join(pieces)
+                pieces = []
+                start = i + len(sep)
+            cut = max(start, len(window) - keep)
+            pieces.append(window[start:cut])
+            tail = window[cut:]
+        pieces.append(tail)
+        yield "".join(pieces)
+
+
+
+def torope(x):
+    if x.tt == "rope":
+        return x.w
+    return Rope.from_str(str(x.w))
+
+
+def rope_split(a, b):
+    if not b.w:
+        # Before the lazy split is consumed, like str split raises
+        raise ValueError("empty separator")
+    xs = (Leaf(TT.STRING, x) for x in a.w.split(b.w))
+    return Leaf("seq", Seq(xs))
+
+
+modules = {
+    "rope": {
+        ("~", "rope"): lambda a, b: Leaf("rope", a.w + b.w),
+        ("~", TT.STRING): lambda a, b: Leaf("rope", a.w + b.w),
+        ("~", TT.SYMBOL): lambda a, b: Leaf("rope", a.w + b.w),
+        ("@", TT.NUM): lambda a, b: Leaf(TT.STRING, a.w.index(b.w)),
+        ("@", TT.TREE): lambda a, b: Leaf("rope", a.w.slice(b.L.w, b.R.w)),
+        ("/", TT.STRING): rope_split,
+        ("=", "rope"): lambda a, b: Leaf(TT.NUM, int(a.w == b.w)),
+        ("=", TT.STRING): lambda a, b: Leaf(TT.NUM, int(a.w == b.w)),
+        "len": lambda a, b: Leaf(TT.NUM, len(a.w)),
+        "depth": lambda a, b: Leaf(TT.NUM, a.w.depth),
+        "torope": lambda a, b: a,
+        "tostr": lambda a, b: Leaf(TT.STRING, str(a.w)),
+    },
+    TT.STRING: {
+        "torope": lambda a, b: Leaf("rope", torope(a)),
+        ("~", "rope"): lambda a, b: Leaf("rope", a.w + b.w),
+    },
+}
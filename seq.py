@@ -0,0 +1,30 @@
+""" Lazy sequence backing hb's `seq`.
+
+A seq wraps a python iterator: items are made as they are consumed and
+only once. It can be consumed by one thing, eg. tovec, fold or take, and
+consuming it again is an error instead of silently going on where the
+first consumer stopped. toseq of a vec or a range makes a new one.
+"""
+
+from c import TypecheckError
+
+
+class Seq:
+
+    __slots__ = ("items", "consumed")
+
+    def __init__(self, items):
+        self.items = iter(items)
+        self.consumed = False
+
+    def __iter__(self):
+        if self.consumed:
+            raise TypecheckError("seq: Already consumed, a seq is single pass")
+        self.consumed = True
+        return self.items
+
+    def __str__(self):
+        return "<seq>"
+
+    def __repr__(self):
+        return str(self)
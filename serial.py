@@ -0,0 +1,406 @@
+""" Binary codec for hb values.
+
+Stream layout: MAGIC, VERSION byte, then one encoded value. Every value
+starts with an opcode byte. Composite objects (Leaf, Tree, Env, Function,
+lists, ...) are numbered in the order they are first written; repeated
+occurrences are written as REF + number, which keeps shared substructure
+shared and makes cycles through Env parents terminate.
+"""
+
+from array import array
+
+from c import Tree, Leaf, TT, Unit, DebugInfo
+from stack import Stack, Frame, CT
+from matrix import Matrix
+from rope import Rope
+from strvec import StrVec, DictStrVec
+from pvec import PVec
+from hmap import HMap
+from record import Record
+
+
+MAGIC = b"HB"
+VERSION = 1
+
+
+class CodecError(Exception):
+    pass
+
+
+(NONE, TRUE, FALSE, INT, STR, BYTES, LIST, TUPLE, SET, DICT,
+ LEAF, TREE, UNIT, DEBUG, TT_ENUM, ENV, ROOT, FUNCTION, BUILTIN,
+ SOME, MATRIX, STACK, FRAME, REF, ROPE, STR_VEC, DICT_STR_VEC,
+ PVEC, HMAP, RECORD) = range(30)
+
+
+def write_uint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def write_int(out, n):
+    # zigzag, so that small negative numbers stay short
+    write_uint(out, n << 1 if n >= 0 else ((-n) << 1) - 1)
+
+
+def write_str(out, s):
+    b = s.encode("utf-8")
+    write_uint(out, len(b))
+    out += b
+
+
+class Codec:
+    """ Encoder/decoder bound to an interpreter.
+
+    `env_cls` and `fn_cls` are hb's Env and Function classes. `builtins`
+    maps a stable name to every native function reachable from hb, so that
+    BUILTIN and SPECIAL leaves can be written by name and resolved again on
+    the other side.
+    """
+
+    def __init__(self, env_cls, fn_cls, some_cls, builtins):
+        self.env_cls = env_cls
+        self.fn_cls = fn_cls
+        self.some_cls = some_cls
+        self.by_name = dict(builtins)
+        self.by_fn = {id(fn): name for name, fn in self.by_name.items()}
+
+    def dumps(self, x, root=None, debug=True):
+        """ Serialize x. Env `root` (eg. prepared root env) is written as
+        a reference only and has to be supplied again to `loads`.
+        """
+        out = bytearray(MAGIC)
+        out.append(VERSION)
+        Encoder(self, root, debug).value(out, x)
+        return bytes(out)
+
+    def loads(self, data, root=None):
+        if data[:len(MAGIC)] != MAGIC:
+            raise CodecError("Not a serialized hb value")
+        version = data[len(MAGIC)]
+        if version != VERSION:
+            raise CodecError(f"Unsupported codec version {version}")
+        return Decoder(self, data, len(MAGIC) + 1, root).value()
+
+
+class Encoder:
+
+    def __init__(self, codec, root, debug):
+        self.codec = codec
+        self.root = root
+        self.debug = debug
+        self.seen = {}
+        # Keep encoded objects alive so that their ids stay unique
+        self.alive = []
+
+    def memo(self, out, x):
+        ref = self.seen.get(id(x))
+        if ref is not None:
+            out.append(REF)
+            write_uint(out, ref)
+            return True
+        self.seen[id(x)] = len(self.seen)
+        self.alive.append(x)
+        return False
+
+    def value(self, out, x):
+        if x is None:
+            out.append(NONE)
+        elif x is True:
+            out.append(TRUE)
+        elif x is False:
+            out.append(FALSE)
+        elif isinstance(x, int):
+            out.append(INT)
+            write_int(out, x)
+        elif isinstance(x, str):
+            out.append(STR)
+            write_str(out, x)
+        elif isinstance(x, TT):
+            out.append(TT_ENUM)
+            write_uint(out, x.value)
+        elif x is Unit:
+            out.append(UNIT)
+        elif x is self.root:
+            out.append(ROOT)
+        elif isinstance(x, tuple):
+            # Tuples are immutable, so they can't close a cycle themselves
+            out.append(TUPLE)
+            write_uint(out, len(x))
+            for y in x:
+                self.value(out, y)
+        elif self.memo(out, x):
+            pass
+        elif isinstance(x, Leaf):
+            out.append(LEAF)
+            self.value(out, x.tt)
+            self.value(out, x.w)
+            self.value(out, x.debug if self.debug else None)
+        elif isinstance(x, Tree):
+            out.append(TREE)
+            self.value(out, x.L)
+            self.value(out, x.H)
+            self.value(out, x.R)
+            self.value(out, x.debug if self.debug else None)
+        elif isinstance(x, DebugInfo):
+            out.append(DEBUG)
+            self.value(out, x.start)
+            self.value(out, x.end)
+            self.value(out, x.lineno)
+        elif isinstance(x, list):
+            out.append(LIST)
+            write_uint(out, len(x))
+            for y in x:
+                self.value(out, y)
+        elif isinstance(x, (set, frozenset)):
+            out.append(SET)
+            write_uint(out, len(x))
+            for y in x:
+                self.value(out, y)
+        elif isinstance(x, dict):
+            out.append(DICT)
+            write_uint(out, len(x))
+            for k, v in x.items():
+                self.value(out, k)
+                self.value(out, v)
+        elif isinstance(x, (bytes, bytearray)):
+            out.append(BYTES)
+            write_uint(out, len(x))
+            out += x
+        elif isinstance(x, self.codec.env_cls):
+            out.append(ENV)
+            self.value(out, x.parent)
+            self.value(out, x.e)
+        elif isinstance(x, Record):
+            out.append(RECORD)
+            self.value(out, x.parent)
+            fields = x.e
+            self.value(out, tuple(fields))
+            self.value(out, list(fields.values()))
+        elif isinstance(x, self.codec.fn_cls):
+            out.append(FUNCTION)
+            self.value(out, x.left_name)
+            self.value(out, x.right_name)
+            self.value(out, x.body)
+            self.value(out, x.env)
+        elif isinstance(x, self.codec.some_cls):
+            out.append(SOME)
+            self.value(out, x.value)
+        elif isinstance(x, Matrix):
+            out.append(MATRIX)
+            self.value(out, x._shape)
+            self.value(out, x._ar)
+        elif isinstance(x, Rope):
+            out.append(ROPE)
+            write_str(out, str(x))
+        elif isinstance(x, PVec):
+            out.append(PVEC)
+            write_uint(out, len(x))
+            for y in x:
+                self.value(out, y)
+        elif isinstance(x, HMap):
+            out.append(HMAP)
+            write_uint(out, len(x))
+            for k, v in x.items():
+                self.value(out, k)
+                self.value(out, v)
+        elif isinstance(x, StrVec):
+            out.append(STR_VEC)
+            self.value(out, bytes(x.buf))
+            self.value(out, x.offsets.tobytes())
+        elif isinstance(x, DictStrVec):
+            out.append(DICT_STR_VEC)
+            self.value(out, x.codes.tobytes())
+            self.value(out, x.values)
+        elif isinstance(x, Stack):
+            out.append(STACK)
+            self.value(out, x.tag)
+            self.value(out, x.s)
+        elif isinstance(x, Frame):
+            out.append(FRAME)
+            write_uint(out, x.ct.value)
+            self.value(out, x.L)
+            self.value(out, x.H)
+            self.value(out, x.R)
+            self.value(out, x.env)
+        elif callable(x) and id(x) in self.codec.by_fn:
+            out.append(BUILTIN)
+            write_str(out, self.codec.by_fn[id(x)])
+        else:
+            raise CodecError(f"Can't serialize '{type(x).__name__}'")
+
+
+class Decoder:
+
+    def __init__(self, codec, data, pos, root):
+        self.codec = codec
+        self.data = data
+        self.pos = pos
+        self.root = root
+        self.objs = []
+
+    def uint(self):
+        n, shift = 0, 0
+        while True:
+            b = self.data[self.pos]
+            self.pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def int(self):
+        n = self.uint()
+        return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+    def raw(self, n):
+        b = self.data[self.pos : self.pos + n]
+        self.pos += n
+        return b
+
+    def str(self):
+        return self.raw(self.uint()).decode("utf-8")
+
+    def new(self, x):
+        self.objs.append(x)
+        return x
+
+    def value(self):
+        op = self.data[self.pos]
+        self.pos += 1
+
+        if op == NONE:
+            return None
+        elif op == TRUE:
+            return True
+        elif op == FALSE:
+            return False
+        elif op == INT:
+            return self.int()
+        elif op == STR:
+            return self.str()
+        elif op == TT_ENUM:
+            return TT(self.uint())
+        elif op == UNIT:
+            return Unit
+        elif op == ROOT:
+            if self.root is None:
+                raise CodecError("Value refers to root env, but none given")
+            return self.root
+        elif op == TUPLE:
+            return tuple(self.value() for _ in range(self.uint()))
+        elif op == REF:
+            return self.objs[self.uint()]
+        elif op == LEAF:
+            x = self.new(Leaf(None, None))
+            x.tt = self.value()
+            x.w = self.value()
+            x.debug = self.value()
+            return x
+        elif op == TREE:
+            x = self.new(Tree(None, None, None))
+            x.L = self.value()
+            x.H = self.value()
+            x.R = self.value()
+            x.debug = self.value()
+            return x
+        elif op == DEBUG:
+            x = self.new(DebugInfo(None, None, None))
+            x.start = self.value()
+            x.end = self.value()
+            x.lineno = self.value()
+            return x
+        elif op == LIST:
+            x = self.new([])
+            for _ in range(self.uint()):
+                x.append(self.value())
+            return x
+        elif op == SET:
+            x = self.new(set())
+            for _ in range(self.uint()):
+                x.add(self.value())
+            return x
+        elif op == DICT:
+            x = self.new({})
+            for _ in range(self.uint()):
+                k = self.value()
+                x[k] = self.value()
+            return x
+        elif op == BYTES:
+            return self.new(bytes(self.raw(self.uint())))
+        elif op == ENV:
+            x = self.new(self.codec.env_cls(None))
+            x.parent = self.value()
+            x.e = self.value()
+            return x
+        elif op == RECORD:
+            x = self.new(Record(None))
+            x.parent = self.value()
+            keys = self.value()
+            x.set_fields(keys, self.value())
+            return x
+        elif op == FUNCTION:
+            x = self.new(self.codec.fn_cls(None, None, None, None))
+            x.left_name = self.value()
+            x.right_name = self.value()
+            x.body = self.value()
+            x.env = self.value()
+            return x
+        elif op == SOME:
+            x = self.new(self.codec.some_cls(None))
+            x.value = self.value()
+            return x
+        elif op == MATRIX:
+            x = self.new(Matrix([], []))
+            x._shape = self.value()
+            x._ar = self.value()
+            return x
+        elif op == ROPE:
+            return self.new(Rope.from_str(self.str()))
+        elif op == PVEC:
+            # Reserve slot, PVec can only be built once its items are known
+            slot = len(self.objs)
+            self.new(None)
+            n = self.uint()
+            x = self.objs[slot] = PVec.from_list([self.value() for _ in range(n)])
+            return x
+        elif op == HMAP:
+            slot = len(self.objs)
+            self.new(None)
+            n = self.uint()
+            pairs = [(self.value(), self.value()) for _ in range(n)]
+            x = self.objs[slot] = HMap.from_pairs(pairs)
+            return x
+        elif op == STR_VEC:
+            x = self.new(StrVec(None, array("q")))
+            x.buf = self.value()
+            x.offsets.frombytes(self.value())
+            return x
+        elif op == DICT_STR_VEC:
+            x = self.new(DictStrVec(array("l"), None))
+            x.codes.frombytes(self.value())
+            x.values = self.value()
+            return x
+        elif op == STACK:
+            x = self.new(Stack(None))
+            x.tag = self.value()
+            for frame in self.value():
+                x.push(frame)
+            return x
+        elif op == FRAME:
+            x = self.new(Frame(None, None, None, None, None))
+            x.ct = CT(self.uint())
+            x.L = self.value()
+            x.H = self.value()
+            x.R = self.value()
+            x.env = self.value()
+            return x
+        elif op == BUILTIN:
+            name = self.str()
+            fn = self.codec.by_name.get(name)
+            if fn is None:
+                raise CodecError(f"Unknown builtin '{name}'")
+            return self.new(fn)
+        raise CodecError(f"Unknown opcode {op} at {self.pos - 1}")
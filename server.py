@@ -0,0 +1,168 @@
+""" Warm interpreter server.
+
+hb.py serve loads the prelude (and --lib files) into a root env once, then
+forks worker processes that share it copy-on-write and accept on one Unix
+socket. A client sends hb source and shuts down its writing side, the
+reply is JSON {"result": ..., "stdout": ..., "stderr": ...}.
+
+Every request runs in a child env of the warm root. Assigning a name of
+the root binds it in the child, shared modules can't be changed. A
+worker exits after MAX_REQUESTS requests and a fresh one is forked from
+the warm server, so whatever else a request changed doesn't live long.
+
+    hb.py [-j WORKERS] serve [SOCKET] [--lib FILE ...] [--fuel N] [--timeout SECONDS]
+    server.py [SOCKET] [FILE]    send FILE or stdin, print like hb.py run
+"""
+
+from contextlib import redirect_stderr, redirect_stdout
+import gc
+import io
+import json
+import os
+import signal
+import socket
+import sys
+
+
+SOCKET = "/tmp/hb.sock"
+LIBS = ["lib/prelude.hb"]
+# Requests a worker serves before it's replaced
+MAX_REQUESTS = 1000
+
+
+def recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def warm(hb, libs):
+    """ Root env with libs loaded, it and its modules marked shared """
+    root = hb.prepare_env()
+    for path in libs:
+        with open(path) as f:
+            code = f.read()
+        _, _, env, _ = hb.Execute(code, root, hb.Cactus(hb.ROOT_TAG))
+        if env is None:
+            raise SystemExit(f"serve: Can't load {path}")
+    # First run of the interpreter itself, parser and optimizer included
+    hb.Execute("1 + 1", hb.Env(root), hb.Cactus(hb.ROOT_TAG))
+
+    root.shared = True
+    for x in root.e.values():
+        if isinstance(x, hb.Leaf) and x.tt == hb.TT.OBJECT and isinstance(x.w, hb.Env):
+            x.w.shared = True
+    return root
+
+
+def run(hb, root, src, fuel, timeout):
+    """ Reply to one request """
+    out, err = io.StringIO(), io.StringIO()
+    budget = None
+    if fuel is not None or timeout is not None:
+        budget = hb.Budget(fuel, timeout)
+    with redirect_stdout(out), redirect_stderr(err):
+        try:
+            x, _, _, _ = hb.Execute(src, hb.Env(root), hb.Cactus(hb.ROOT_TAG),
+                                    budget=budget)
+        except Exception as exc:
+            # Errors Execute doesn't report itself, eg. TypecheckError
+            print(exc, file=sys.stderr)
+            x = hb.Unit
+    return {"result": str(x), "stdout": out.getvalue(), "stderr": err.getvalue()}
+
+
+def worker(sock, hb, root, fuel, timeout):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    for _ in range(MAX_REQUESTS):
+        conn, _ = sock.accept()
+        with conn:
+            try:
+                src = recv_all(conn).decode()
+                reply = run(hb, root, src, fuel, timeout)
+                conn.sendall(json.dumps(reply).encode())
+            except OSError:
+                # Client went away
+                pass
+
+
+def serve(path=SOCKET, workers=None, libs=LIBS, fuel=None, timeout=None):
+    import hb
+    root = warm(hb, libs)
+    workers = workers or os.cpu_count() or 1
+
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(128)
+    # Collections would touch every warm object and unshare its page
+    gc.freeze()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving on {path} with {workers} workers", file=sys.stderr)
+
+    children = set()
+    try:
+        while True:
+            while len(children) < workers:
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        worker(sock, hb, root, fuel, timeout)
+                    finally:
+                        os._exit(0)
+                children.add(pid)
+            pid, _ = os.wait()
+            children.discard(pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        sock.close()
+        os.unlink(path)
+
+
+def main(args, workers=None):
+    """ hb.py serve arguments """
+    path, libs, fuel, timeout = SOCKET, [], None, None
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == "--lib":
+            libs.append(args.pop(0))
+        elif arg == "--fuel":
+            fuel = int(args.pop(0))
+        elif arg == "--timeout":
+            timeout = float(args.pop(0))
+        else:
+            path = arg
+    serve(path, workers, LIBS + libs, fuel, timeout)
+
+
+def send(src, path=SOCKET):
+    """ Run src on the server listening at path, returns its reply """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(src.encode())
+        sock.shutdown(socket.SHUT_WR)
+        return json.loads(recv_all(sock))
+
+
+if __name__ == "__main__":
+    # Client, without importing the interpreter
+    path = sys.argv[1] if len(sys.argv) > 1 else SOCKET
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            src = f.read()
+    else:
+        src = sys.stdin.read()
+
+    reply = send(src, path)
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    print(reply["result"])
@@ -1,8 +1,9 @@
-from enum import Enum
+from collections import deque
+from enum import IntEnum
 from typing import Union
 
 
-class CT(Enum):
+class CT(IntEnum):
     Leaf = 0
     Tree = 1
     Left = 2
@@ -10,15 +11,11 @@ class CT(Enum):
     Right = 4
     Return = 5
     Function = 6
-
-    def __lt__(self, other):
-        return self.value < other.value
-
-    def __eq__(self, other):
-        return self.value == other.value
-
-    def __le__(self, other):
-        return self.value <= other.value
+    Generator = 7
+    Loop = 8
+    Handler = 9
+    Iter = 10
+    Task = 11
 
 
 class Frame:
@@ -35,25 +32,57 @@ class Frame:
         # return f"F {s.ct} ({s.L} {s.H} {s.R})"
 
 
+class Link:
+    """ Immutable cons cell of frames. Stacks sharing a tail share frames. """
+
+    __slots__ = ("frame", "next")
+
+    def __init__(self, frame, next):
+        self.frame = frame
+        self.next = next
+
+
 class Stack:
+    """ Stack segment delimited by reset tag. Frames are kept in immutable
+    linked list, so capturing a segment and reinstating it is O(1).
+    """
 
-    def __init__(self, tag):
+    def __init__(self, tag, top=None):
         self.tag = tag
-        self.s = []
+        self.top = top
+
+    @property
+    def s(self):
+        """ Frames bottom to top """
+        frames = []
+        link = self.top
+        while link is not None:
+            frames.append(link.frame)
+            link = link.next
+        return frames[::-1]
+
+    @staticmethod
+    def from_frames(tag, frames):
+        st = Stack(tag)
+        for x in frames:
+            st.push(x)
+        return st
 
     def empty(self):
-        return len(self.s) == 0
+        return self.top is None
 
     def push(self, x: Frame):
-        self.s.append(x)
+        self.top = Link(x, self.top)
 
     def pop(self):
-        return self.s.pop()
+        link = self.top
+        self.top = link.next
+        return link.frame
 
     def peek(self):
-        if self.empty():
+        if self.top is None:
             return None
-        return self.s[-1]
+        return self.top.frame
 
 
 class Cactus:
@@ -66,6 +95,14 @@ class Cactus:
 
     def __init__(self, tag: str):
         self.rope = []
+        # Green threads. Each task owns a rope, running one is in self.rope
+        self.run_queue = deque()
+        self.task = None
+        self.main = None
+        # Timers and I/O parked tasks wait on, made on first use
+        self.reactor = None
+        # Budget of the Execute running on this stack, kept across resumes
+        self.budget = None
         self.spush(tag)
 
     def spush(self, tag: str):
@@ -79,15 +116,71 @@ class Cactus:
             if st.tag == tag:
                 return st
 
+    def sresume(self, st: Stack):
+        # One-shot resume, reinstate st itself instead of a copy
+        self.rope.append(st)
+
     def scopy(self, st: Stack):
-        self.spush(st.tag)
-        # TODO Refactor loop. Insert into stack directly and then push stack onto cactus stack.
-        for x in st.s:
-            self.push(x)
+        # Share captured frames, pushes onto the copy don't touch st
+        self.rope.append(Stack(st.tag, st.top))
 
     def push(self, x: Frame):
         self.rope[-1].push(x)
 
+    def find(self, ct: CT, accept, stop_tag: str,
+             barriers=(CT.Return, CT.Generator, CT.Task)):
+        """ Look up, without popping, the nearest accepted frame of kind ct.
+        Returns barrier frame if one comes first, None when segment tagged
+        stop_tag or the bottom is reached first.
+        """
+        for st in reversed(self.rope):
+            link = st.top
+            while link is not None:
+                frame = link.frame
+                if frame.ct == ct and accept(frame):
+                    return frame
+                if frame.ct in barriers:
+                    return frame
+                link = link.next
+            if st.tag == stop_tag:
+                return None
+        return None
+
+    def unwind_past(self, frame: Frame):
+        """ Pop frames up to and including given frame """
+        while True:
+            st = self.rope[-1]
+            if st.empty():
+                self.rope.pop()
+                continue
+            if st.pop() is frame:
+                return
+
+    def unwind(self, ct: CT, barriers=(CT.Return, CT.Generator, CT.Task)):
+        """ Drop frames above the nearest frame of kind ct and return it.
+        Never crosses a barrier frame.
+        """
+        while self.rope:
+            st = self.rope[-1]
+            if st.empty():
+                self.rope.pop()
+                continue
+            frame = st.peek()
+            if frame.ct == ct:
+                return frame
+            if frame.ct in barriers:
+                break
+            st.pop()
+        raise Cactus.Empty(f"No {ct.name} frame", ct.name)
+
+    def frames(self):
+        """ All frames, top to bottom """
+        for st in reversed(self.rope):
+            link = st.top
+            while link is not None:
+                yield link.frame
+                link = link.next
+
     def peek(self) -> Union[Frame, None]:
         if not self.rope: # TODO include this? Not tested...
             raise Cactus.Empty("PEEKING empty", "__peek__")
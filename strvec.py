@@ -0,0 +1,247 @@
+from array import array
+from bisect import bisect_right
+
+from c import Leaf, Tree, TT, Unit
+from pvec import PVec
+from seq import Seq
+
+
+class StrVec:
+    """ Strings packed into one UTF-8 buffer, row i is buf[off[i]:off[i+1]] """
+
+    __slots__ = ("buf", "offsets")
+
+    def __init__(self, buf, offsets):
+        self.buf = buf
+        self.offsets = offsets
+
+    @staticmethod
+    def from_strs(strs):
+        return StrVec.from_raw(s.encode("utf-8") for s in strs)
+
+    @staticmethod
+    def from_raw(raws):
+        parts = []
+        offsets = array("q", [0])
+        pos = 0
+        for b in raws:
+            parts.append(b)
+            pos += len(b)
+            offsets.append(pos)
+        return StrVec(b"".join(parts), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        o = self.offsets
+        return self.buf[o[i] : o[i + 1]]
+
+    def get(self, i):
+        if i < 0:
+            i += len(self)
+        return self.raw(i).decode("utf-8")
+
+    def raws(self):
+        buf, o = self.buf, self.offsets
+        return (buf[o[i] : o[i + 1]] for i in range(len(self)))
+
+    def strs(self):
+        return (b.decode("utf-8") for b in self.raws())
+
+    def lengths(self):
+        o = self.offsets
+        if self.buf.isascii():
+            return [o[i + 1] - o[i] for i in range(len(self))]
+        return [len(s) for s in self.strs()]
+
+    def hits(self, needle, whole):
+        """ Rows containing needle, found by scanning the whole buffer
+        instead of visiting every row.
+        """
+        buf, o = self.buf, self.offsets
+        n = len(needle)
+        mask = [0] * len(self)
+        pos = buf.find(needle)
+        while pos >= 0:
+            row = bisect_right(o, pos) - 1
+            end = o[row + 1]
+            if whole:
+                # Only a match starting the row can fill it whole
+                if pos == o[row] and pos + n == end:
+                    mask[row] = 1
+                pos = buf.find(needle, end)
+            elif pos + n <= end:
+                mask[row] = 1
+                pos = buf.find(needle, end)
+            else:
+                # Match crosses row boundary
+                pos = buf.find(needle, pos + 1)
+        return mask
+
+    def eq(self, s):
+        needle = s.encode("utf-8")
+        if not needle:
+            return [int(n == 0) for n in self.lengths()]
+        return self.hits(needle, True)
+
+    def contains(self, s):
+        needle = s.encode("utf-8")
+        if not needle:
+            return [1] * len(self)
+        return self.hits(needle, False)
+
+    def prefix(self, s):
+        needle = s.encode("utf-8")
+        buf, o = self.buf, self.offsets
+        return [int(buf.startswith(needle, o[i], o[i + 1])) for i in range(len(self))]
+
+    def order(self):
+        raw = self.raw
+        # UTF-8 byte order is code point order
+        return sorted(range(len(self)), key=raw)
+
+    def take(self, indices):
+        raw = self.raw
+        return StrVec.from_raw(raw(i) for i in indices)
+
+    def suffix(self, s):
+        s = s.encode("utf-8")
+        return StrVec.from_raw(b + s for b in self.raws())
+
+    def concat(self, other):
+        shift = len(self.buf)
+        offsets = self.offsets[:]
+        offsets.extend(o + shift for o in other.offsets[1:])
+        return StrVec(self.buf + other.buf, offsets)
+
+    def encode(self):
+        codes = array("l")
+        index = {}
+        for b in self.raws():
+            code = index.get(b)
+            if code is None:
+                code = index[b] = len(index)
+            codes.append(code)
+        return DictStrVec(codes, StrVec.from_raw(index))
+
+    def decode(self):
+        return self
+
+    def nbytes(self):
+        return len(self.buf) + self.offsets.itemsize * len(self.offsets)
+
+    def __str__(self):
+        return str(list(self.strs()))
+
+
+class DictStrVec:
+    """ Dictionary encoded StrVec for low cardinality columns. Operations run
+    once per distinct value and are then broadcast through the codes.
+    """
+
+    __slots__ = ("codes", "values")
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def get(self, i):
+        return self.values.get(self.codes[i])
+
+    def raws(self):
+        values = [self.values.raw(i) for i in range(len(self.values))]
+        return (values[c] for c in self.codes)
+
+    def strs(self):
+        values = list(self.values.strs())
+        return (values[c] for c in self.codes)
+
+    def broadcast(self, per_value):
+        return [per_value[c] for c in self.codes]
+
+    def lengths(self):
+        return self.broadcast(self.values.lengths())
+
+    def eq(self, s):
+        return self.broadcast(self.values.eq(s))
+
+    def contains(self, s):
+        return self.broadcast(self.values.contains(s))
+
+    def prefix(self, s):
+        return self.broadcast(self.values.prefix(s))
+
+    def order(self):
+        rank = [0] * len(self.values)
+        for k, i in enumerate(self.values.order()):
+            rank[i] = k
+        codes = self.codes
+        return sorted(range(len(self)), key=lambda i: rank[codes[i]])
+
+    def take(self, indices):
+        codes = self.codes
+        return DictStrVec(array("l", (codes[i] for i in indices)), self.values)
+
+    def suffix(self, s):
+        return DictStrVec(self.codes, self.values.suffix(s))
+
+    def concat(self, other):
+        return self.decode().concat(other.decode())
+
+    def encode(self):
+        return self
+
+    def decode(self):
+        return StrVec.from_raw(self.raws())
+
+    def nbytes(self):
+        return self.codes.itemsize * len(self.codes) + self.values.nbytes()
+
+    def __str__(self):
+        return str(list(self.strs()))
+
+
+def tostrvec(a, b):
+    return Leaf("str_vec", StrVec.from_strs(str(x.w) for x in a.w))
+
+
+def eq_strvec(a, b):
+    if len(a.w) != len(b.w):
+        raise ValueError("str_vec lengths don't match")
+    return Leaf("num_vec", [int(x == y) for x, y in zip(a.w.raws(), b.w.raws())])
+
+
+modules = {
+    "str_vec": {
+        "len": lambda a, b: Leaf(TT.NUM, len(a.w)),
+        "strlen": lambda a, b: Leaf("num_vec", a.w.lengths()),
+        ("=", TT.STRING): lambda a, b: Leaf("num_vec", a.w.eq(b.w)),
+        ("=", "str_vec"): eq_strvec,
+        ("prefix", TT.STRING): lambda a, b: Leaf("num_vec", a.w.prefix(b.w)),
+        ("contains", TT.STRING): lambda a, b: Leaf("num_vec", a.w.contains(b.w)),
+        ("~", "str_vec"): lambda a, b: Leaf("str_vec", a.w.concat(b.w)),
+        ("~", TT.STRING): lambda a, b: Leaf("str_vec", a.w.suffix(b.w)),
+        ("@", TT.NUM): lambda a, b: Leaf(TT.STRING, a.w.get(b.w)),
+        ("@", "num_vec"): lambda a, b: Leaf("str_vec", a.w.take(b.w)),
+        "order": lambda a, b: Leaf("num_vec", a.w.order()),
+        "encode": lambda a, b: Leaf("str_vec", a.w.encode()),
+        "decode": lambda a, b: Leaf("str_vec", a.w.decode()),
+        "nbytes": lambda a, b: Leaf(TT.NUM, a.w.nbytes()),
+        "tovec": lambda a, b: Leaf("vec", PVec.from_list(Leaf(TT.STRING, s) for s in a.w.strs())),
+        "toseq": lambda a, b: Leaf("seq", Seq(Leaf(TT.STRING, s) for s in a.w.strs())),
+        "each": lambda a, b: Tree(Tree(a, Leaf(TT.SYMBOL, "tovec"), Unit), Leaf(TT.SYMBOL, "each"), b),
+    },
+    "vec": {
+        "tostrvec": tostrvec,
+    },
+    "seq": {
+        "tostrvec": tostrvec,
+    },
+    "num_vec": {
+        "where": lambda a, b: Leaf("num_vec", [i for i, x in enumerate(a.w) if x]),
+    },
+}